@@ -8,8 +8,12 @@ from pprint import pprint
 import pandas as pd
 import azure.mgmt.resourcegraph as arg
 from azure.identity import DefaultAzureCredential
-import os, sys, json, base64, pathlib
-from datetime import date
+from azure.core.exceptions import HttpResponseError
+import os, sys, json, base64, pathlib, zipfile, gzip, shutil, tempfile, re, hashlib, time, uuid, zlib, heapq, threading, queue
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from azure.keyvault.secrets import SecretClient
 #from azure.mgmt.resource import SubscriptionClient
 import automationassets
@@ -22,15 +26,82 @@ from sendgrid.helpers.mail import Mail, Email, To, Content, Attachment, FileCont
 KEY_VAULT = automationassets.get_automation_variable(str("KEY_VAULT_NAME"))  #change to your own variable name 
 # Retreiving name of the Secret inside key vault that contain sendgrid api key.
 SG_API_KEY = automationassets.get_automation_variable("sendgridAPIKEY")      # change to your own variable name
+# Retreiving name of the Secret inside key vault that contain a storage connection string, used to share reports too large to mail.
+# This variable is optional, reports that are over the attachment limit can't be sent without it.
+try:
+	BLOB_CONN_STR = automationassets.get_automation_variable("blobConnectionString")
+except Exception:
+	BLOB_CONN_STR = None
+
+# Largest compressed attachment in bytes that is mailed inline (sendgrid limits a mail to 30MB after base64 encoding).
+MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024
+
+# Resource graph allows 15 requests every 5 seconds per user, shard queries running in parallel share this quota.
+ARG_QUOTA_REQUESTS = 15
+ARG_QUOTA_PERIOD = 5
+# Number of shards planned for every worker, more shards than workers keeps the workers busy when shards are uneven.
+SHARDS_PER_WORKER = 4
+# Rows handed over from a shard worker at a time, the largest resource graph page.
+SHARD_BATCH_ROWS = 1000
+# Summarize results can't be paged, the plan query asks for this many rows and the estate is crawled without shards
+# when its result is truncated.
+MAX_PLAN_ROWS = 1000
+
+# Columns of the sheets in the changes only report.
+CHANGE_COLUMNS = ('id', 'type', 'name', 'resourceGroup')
+
+# Columns that are never pruned from a sheet, however sparsely they are filled.
+KEEP_COLUMNS = ('id', 'name', 'type', 'kind', 'location', 'resourceGroup', 'subscriptionId')
+# Column that holds sparse columns of a resource as json when they are folded instead of dropped.
+SPARSE_COLUMN = 'sparse_properties'
+# Most characters an excel cell holds, longer values are cut by xlsxwriter.
+EXCEL_CELL_LIMIT = 32767
+# Columns with a handful of distinct repeating strings, these are stored with the categorical dtype.
+CATEGORY_COLUMNS = ('type', 'kind', 'location', 'resourceGroup', 'subscriptionId', 'tenantId', 'sku_name', 'sku_tier')
+CATEGORY_SUFFIXES = ('provisioningState', 'location', 'diskState', 'osType')
+
+
+class ColumnStats:
+	"""Counts resources and filled values of every column per resource type, while resources are being flattened."""
+	def __init__(self):
+		self.rows = {}
+		self.filled = {}
+
+	@staticmethod
+	def is_empty(value):
+		return value is None or value == '' or value == [] or value == {}
+
+	def update(self, row):
+		"""Adds a flattened resource to the counts of its type"""
+		typ = row.get('type')
+		self.rows[typ] = self.rows.get(typ, 0) + 1
+		filled = self.filled.setdefault(typ, {})
+		for key, value in row.items():
+			filled[key] = filled.get(key, 0) + (0 if self.is_empty(value) else 1)
+
+	def fill_rate(self, typ, column):
+		"""Returns fraction of resources of a type that have a value for the column"""
+		total = self.rows.get(typ, 0)
+		if total == 0:
+			return 0.0
+		return self.filled.get(typ, {}).get(column, 0) / total
+
+	def sparse_columns(self, typ, min_fill_rate):
+		"""Returns set of columns of a type which are filled for less than min_fill_rate of its resources"""
+		return {column for column in self.filled.get(typ, {})
+				if column not in KEEP_COLUMNS and self.fill_rate(typ, column) < min_fill_rate}
 
 
 class NestedToSimpleDict:
-	"""This class converts a JSON data which is a nested python dictionary into a simple dictionary with no nesting."""
-	def __init__(self, data, separator='_'):
+	"""This class converts a JSON data which is a nested python dictionary into a simple dictionary with no nesting.
+	If a ColumnStats object is passed, the flattened dictionary is counted into it."""
+	def __init__(self, data, separator='_', stats=None):
 		self.data = data
 		self.separator = separator
 		self.simple_dict = {}
 		self._to_single_dict(data)
+		if stats is not None:
+			stats.update(self.simple_dict)
 
 	def _is_list(self, value, last_name):
 		for i, d in enumerate(value):
@@ -68,13 +139,354 @@ class NestedToSimpleDict:
 		return None
 
 
+class QueryCache:
+	"""Caches resource graph query results on local disk, one compressed json lines file per entry.
+	Entries are keyed by the normalized query text and the set of subscriptions, they expire after ttl seconds and
+	the least recently used entries are evicted once the cache grows over max_size bytes."""
+
+	# single or double quoted kql string literals, whitespace inside of them is significant
+	_string_literal = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
+	def __init__(self, cache_dir=None, ttl=900, max_size=256 * 1024 * 1024):
+		if cache_dir is None:
+			cache_dir = os.path.join(tempfile.gettempdir(), 'arg_query_cache')
+		os.makedirs(cache_dir, exist_ok=True)
+		self.cache_dir = cache_dir
+		self.ttl = ttl
+		self.max_size = max_size
+
+	@classmethod
+	def normalize_query(cls, query):
+		"""Collapses whitespace outside of string literals, so differently formatted queries share an entry"""
+		parts = cls._string_literal.split(query)
+		# string literals are captured by the split and end up at the odd indexes
+		for i in range(0, len(parts), 2):
+			parts[i] = ' '.join(parts[i].split())
+		return ''.join(parts)
+
+	def _path(self, query, subscriptions):
+		key = json.dumps([self.normalize_query(query), sorted(subscriptions)])
+		return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json.gz')
+
+	@staticmethod
+	def _remove(path):
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+	@staticmethod
+	def _iter_rows(f):
+		with f:
+			for line in f:
+				yield json.loads(line)
+
+	def get(self, query, subscriptions):
+		"""Returns an iterator over the cached rows of a query, or None if there is no fresh entry for it"""
+		path = self._path(query, subscriptions)
+		try:
+			f = gzip.open(path, 'rt', encoding='utf-8')
+			header = json.loads(f.readline())
+		except (OSError, EOFError, ValueError):
+			return None
+
+		if time.time() - header['created'] > self.ttl:
+			f.close()
+			self._remove(path)
+			return None
+
+		# modification time of an entry marks when it was last used, for the LRU eviction
+		os.utime(path)
+		return self._iter_rows(f)
+
+	def put(self, query, subscriptions, rows):
+		"""Yields the rows while writing them to the cache, the entry is only stored once all the rows are consumed"""
+		path = self._path(query, subscriptions)
+		tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+		stored = False
+		try:
+			with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+				header = {'created': time.time(), 'query': query, 'subscriptions': sorted(subscriptions)}
+				f.write(json.dumps(header) + '\n')
+				for row in rows:
+					f.write(json.dumps(row, separators=(',', ':'), default=str) + '\n')
+					yield row
+			os.replace(tmp_path, path)
+			stored = True
+		finally:
+			if not stored:
+				self._remove(tmp_path)
+		self.evict()
+
+	def evict(self):
+		"""Deletes least recently used entries until the cache fits into max_size"""
+		entries = []
+		for entry in os.scandir(self.cache_dir):
+			if not entry.name.endswith('.json.gz'):
+				continue
+			try:
+				stat = entry.stat()
+			except FileNotFoundError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+		total_size = sum(size for _, size, _ in entries)
+		for _, size, path in sorted(entries):
+			if total_size <= self.max_size:
+				break
+			self._remove(path)
+			total_size -= size
+
+	def clear(self):
+		"""Deletes all the entries"""
+		for entry in os.scandir(self.cache_dir):
+			if entry.name.endswith('.json.gz'):
+				self._remove(entry.path)
+
+
+class QueryThrottle:
+	"""Keeps resource graph requests made by any number of threads within the quota of max_requests per period seconds."""
+	def __init__(self, max_requests=ARG_QUOTA_REQUESTS, period=ARG_QUOTA_PERIOD):
+		self.max_requests = max_requests
+		self.period = period
+		self._sent = deque()
+		self._lock = threading.Lock()
+
+	def wait(self):
+		"""Blocks until one more request fits into the quota"""
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				while self._sent and now - self._sent[0] >= self.period:
+					self._sent.popleft()
+				if len(self._sent) < self.max_requests:
+					self._sent.append(now)
+					return
+				delay = self.period - (now - self._sent[0])
+			time.sleep(delay)
+
+
+class ResourceShards(Mapping):
+	"""Spills flattened resources to disk as one compressed json lines file (shard) per resource type.
+	Only a capped number of rows is buffered in memory while collecting, and shards are read back one type at a time."""
+	def __init__(self, shard_dir=None, max_buffered_rows=5000):
+		self.shard_dir = tempfile.mkdtemp(prefix='inventory_shards_', dir=shard_dir)
+		self.max_buffered_rows = max_buffered_rows
+		self._shard_paths = {}
+		self._buffers = {}
+		self._buffered_rows = 0
+
+	def append(self, typ, row):
+		"""Buffers a row of a resource type, all the buffers are written to disk once the cap is reached"""
+		if typ not in self._shard_paths:
+			self._shard_paths[typ] = os.path.join(self.shard_dir, f'shard_{len(self._shard_paths)}.jsonl.gz')
+		self._buffers.setdefault(typ, []).append(row)
+		self._buffered_rows += 1
+		if self._buffered_rows >= self.max_buffered_rows:
+			self.flush()
+
+	def flush(self):
+		"""Appends the buffered rows to their shards"""
+		for typ, rows in self._buffers.items():
+			# every flush adds a new gzip member to the shard, gzip reads all the members back as a single stream
+			with gzip.open(self._shard_paths[typ], 'at', encoding='utf-8', compresslevel=1) as f:
+				for row in rows:
+					f.write(json.dumps(row, separators=(',', ':'), default=str))
+					f.write('\n')
+		self._buffers = {}
+		self._buffered_rows = 0
+
+	def iter_rows(self, typ):
+		"""Yields the resources of a type from its shard"""
+		self.flush()
+		with gzip.open(self._shard_paths[typ], 'rt', encoding='utf-8') as f:
+			for line in f:
+				yield json.loads(line)
+
+	def __getitem__(self, typ):
+		if typ not in self._shard_paths:
+			raise KeyError(typ)
+		return list(self.iter_rows(typ))
+
+	def __contains__(self, typ):
+		return typ in self._shard_paths
+
+	def __iter__(self):
+		return iter(self._shard_paths)
+
+	def __len__(self):
+		return len(self._shard_paths)
+
+	def close(self):
+		"""Deletes the shards from disk"""
+		self._buffers = {}
+		self._buffered_rows = 0
+		shutil.rmtree(self.shard_dir, ignore_errors=True)
+
+
+class InventorySnapshot:
+	"""Fingerprint of an inventory run, keyed by resource id. Every resource keeps a hash of all its properties
+	and a crc32 per property, so changes between two runs are found without keeping the previous inventory itself.
+	Only the hashes are held in memory. Property crcs are written to the snapshot file as resources are added,
+	and are read back only for the resources whose hash has changed."""
+	def __init__(self, taken=None, snapshot_dir=None):
+		self.taken = taken if taken is not None else datetime.utcnow().isoformat(timespec='seconds')
+		self.snapshot_dir = snapshot_dir
+		# resource summaries with their hash, keyed by lower cased id
+		self.resources = {}
+		# compressed json lines file, a header with the time of the snapshot and then [id, summary, property crcs] per resource
+		self.path = None
+		self._file = None
+		self._owns_path = False
+
+	def _writer(self):
+		if self._file is None:
+			if self._owns_path:
+				# adding after the file was closed for reading appends a new gzip member to it
+				self._file = gzip.open(self.path, 'at', encoding='utf-8', compresslevel=1)
+			else:
+				fd, self.path = tempfile.mkstemp(prefix='inventory_snapshot_', suffix='.jsonl.gz', dir=self.snapshot_dir)
+				os.close(fd)
+				self._owns_path = True
+				self._file = gzip.open(self.path, 'wt', encoding='utf-8', compresslevel=1)
+				self._file.write(json.dumps({'taken': self.taken}) + '\n')
+		return self._file
+
+	def _close_writer(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def add(self, row):
+		"""Adds fingerprint of a flattened resource"""
+		res_id = row.get('id')
+		if res_id is None:
+			return
+
+		props = {}
+		digest = hashlib.blake2b(digest_size=16)
+		for key in sorted(row):
+			# every property is serialized only once, feeding both its own crc32 and the hash of the resource
+			encoded = json.dumps([key, row[key]], separators=(',', ':'), sort_keys=True, default=str).encode()
+			props[key] = zlib.crc32(encoded)
+			digest.update(encoded)
+
+		key = str(res_id).lower()
+		entry = {
+			'id': res_id,
+			'type': row.get('type'),
+			'name': row.get('name'),
+			'resourceGroup': row.get('resourceGroup'),
+			'hash': digest.hexdigest()
+		}
+		self.resources[key] = entry
+		self._writer().write(json.dumps([key, entry, props], separators=(',', ':'), default=str) + '\n')
+
+	def load_props(self, res_ids):
+		"""Returns property crcs of the given resources, read from the snapshot file"""
+		props = {}
+		if self.path is None:
+			return props
+		self._close_writer()
+		with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+			f.readline()
+			for line in f:
+				key, _, crcs = json.loads(line)
+				if key in res_ids:
+					props[key] = crcs
+		return props
+
+	@staticmethod
+	def _summary(entry):
+		return {'id': entry['id'], 'type': entry['type'], 'name': entry['name'], 'resourceGroup': entry['resourceGroup']}
+
+	def diff(self, previous):
+		"""Returns 3 lists i.e resources added, removed and modified since the previous snapshot.
+		Modified resources carry names of their added, removed or changed properties."""
+		added, removed, modified = [], [], []
+
+		changed_ids = set()
+		for res_id, entry in self.resources.items():
+			old = previous.resources.get(res_id)
+			if old is None:
+				added.append(self._summary(entry))
+			elif old['hash'] != entry['hash']:
+				changed_ids.add(res_id)
+
+		if changed_ids:
+			# property crcs are only read for resources whose hash has changed
+			props = self.load_props(changed_ids)
+			old_props = previous.load_props(changed_ids)
+			for res_id, entry in self.resources.items():
+				if res_id not in changed_ids:
+					continue
+				new, old = props.get(res_id, {}), old_props.get(res_id, {})
+				changed = sorted(key for key in new.keys() | old.keys() if new.get(key) != old.get(key))
+				summary = self._summary(entry)
+				summary['changed_properties'] = ', '.join(changed)
+				modified.append(summary)
+
+		for res_id, entry in previous.resources.items():
+			if res_id not in self.resources:
+				removed.append(self._summary(entry))
+
+		return added, removed, modified
+
+	def save(self, path):
+		"""Saves the snapshot file to the path"""
+		self._writer()
+		self._close_writer()
+		shutil.copyfile(self.path, path)
+
+	def close(self):
+		"""Closes the snapshot file, deleting it unless it was loaded from a previous run"""
+		self._close_writer()
+		if self._owns_path:
+			try:
+				os.remove(self.path)
+			except FileNotFoundError:
+				pass
+			self.path = None
+			self._owns_path = False
+
+	@classmethod
+	def load(cls, path):
+		"""Loads a snapshot saved by a previous run, returns None if there is no snapshot at the path.
+		Property crcs are left in the file, see load_props."""
+		if not os.path.exists(path):
+			return None
+		with gzip.open(path, 'rt', encoding='utf-8') as f:
+			snapshot = cls(json.loads(f.readline())['taken'])
+			for line in f:
+				key, entry, _ = json.loads(line)
+				snapshot.resources[key] = entry
+		snapshot.path = path
+		return snapshot
+
+
 class DataCollector:
 	"""Collects resources data from Azure and saves them into excel file"""
-	def __init__(self, subscription_id):
+	def __init__(self, subscription_id, spill_to_disk=False, spill_dir=None, max_buffered_rows=5000,
+	  min_fill_rate=0.0, sparse_mode='fold', query_cache=None, max_workers=1):
 		self.subscription_id = subscription_id
 		self.credential= DefaultAzureCredential()
 		self.file_path =  os.environ.get("TEMP")
 		self._keyVaultName = KEY_VAULT
+		# when spilling to disk resources are kept in per type shards instead of memory, see ResourceShards
+		self.spill_to_disk = spill_to_disk
+		self.spill_dir = spill_dir if spill_dir is not None else self.file_path
+		self.max_buffered_rows = max_buffered_rows
+		# columns filled for less than min_fill_rate of the resources of a type are folded into a json column or dropped
+		if sparse_mode not in ('fold', 'drop'):
+			raise Exception("sparse_mode can only be fold or drop")
+		self.min_fill_rate = min_fill_rate
+		self.sparse_mode = sparse_mode
+		self.column_stats = ColumnStats()
+		# resource graph results are reused from this QueryCache when it is set
+		self.query_cache = query_cache
+		# with more than one worker the estate is crawled as shards queried in parallel, see plan_shards
+		self.max_workers = max_workers
+		self.throttle = QueryThrottle()
 
 	# def get_subscriptions(self):
 	# 	"""Get all the subscriptions"""
@@ -101,99 +513,426 @@ class DataCollector:
 		argQueryOptions = arg.models.QueryRequestOptions(result_format=res_format)
 
 		return argClient, argQueryOptions
-	
-	def get_resources(self, query="resources"):
+
+	def run_query_page(self, argClient, query, argQueryOptions):
+		"""Runs a resource graph query and returns one page of its results as a dictionary"""
+
+		for attempt in range(5):
+			self.throttle.wait()
+			try:
+				# Create query
+				argQuery = arg.models.QueryRequest(subscriptions=[self.subscription_id], query=query, options=argQueryOptions)
+
+				# Run query
+				return argClient.resources(argQuery).as_dict()
+
+			except HttpResponseError as e:
+				# throttled by resource graph, backing off before trying the page again
+				if e.status_code == 429 and attempt < 4:
+					time.sleep(ARG_QUOTA_PERIOD * (attempt + 1))
+					continue
+				print(e)
+				print("Error Retreiving data from resource graph!!!")
+				raise
+
+			except Exception as e:
+				print(e)
+				print("Error Retreiving data from resource graph!!!")
+				raise
+
+	def iter_query_results(self, query):
+		"""This yields raw rows of a resource graph query, results are fetched one page at a time"""
+
+		argClient, argQueryOptions = self.arg_login_setup()
+
+		while True:
+			argResults = self.run_query_page(argClient, query, argQueryOptions)
+			yield from argResults['data']
+
+			skip_token = argResults.get('skip_token')
+			if not skip_token:
+				break
+			argQueryOptions = arg.models.QueryRequestOptions(result_format="objectArray", skip_token=skip_token)
+
+	def iter_cached_results(self, query, refresh=False):
+		"""This returns an iterator over raw rows of a query.
+		Results are served from the query cache when it has a fresh entry for the query, refresh=True bypasses it."""
+
+		subscriptions = [self.subscription_id]
+		results = None
+		if self.query_cache is not None and not refresh:
+			results = self.query_cache.get(query, subscriptions)
+
+		if results is None:
+			results = self.iter_query_results(query)
+			if self.query_cache is not None:
+				results = self.query_cache.put(query, subscriptions, results)
+
+		return results
+
+	def iter_resources(self, query="resources", refresh=False):
+		"""This yields info of each resource as a dictionary"""
+
+		for r in self.iter_cached_results(query, refresh=refresh):
+			sd = NestedToSimpleDict(r, stats=self.column_stats)
+			yield sd.simple_dict
+
+	def get_resources(self, query="resources", refresh=False):
 		"""This returns a list containing info of each resource as a dictionary"""
 
-		try:		
-			argClient, argQueryOptions = self.arg_login_setup()
+		return list(self.iter_resources(query, refresh=refresh))
 
-			# Create query
-			argQuery = arg.models.QueryRequest(subscriptions=[self.subscription_id], query=query, options=argQueryOptions)
+	@staticmethod
+	def _kql_string(value):
+		return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
 
-			# Run query
-			argResults = argClient.resources(argQuery)
+	def plan_shards(self, n_shards):
+		"""Splits the estate into at most n_shards resource graph queries with about the same number of resources.
+		Resources are counted by type and resource group with one cheap query, then every (type, resource group) pair,
+		largest first, is given to the shard with the fewest resources so far. A last catch-all shard collects resources
+		of types and resource groups created after the plan was made. Returns None if the estate can't be planned."""
 
-			res = argResults.as_dict()['data']
+		# summarize results have no id column so they come without a skip token, the page size is asked for explicitly
+		# and a truncated result means some of the estate would never get a shard
+		argClient, _ = self.arg_login_setup()
+		argQueryOptions = arg.models.QueryRequestOptions(result_format="objectArray", top=MAX_PLAN_ROWS)
+		argResults = self.run_query_page(argClient, "resources | summarize count_ = count() by type, resourceGroup", argQueryOptions)
+		counts = argResults['data']
+		if str(argResults.get('result_truncated')).lower() == 'true' or len(counts) >= MAX_PLAN_ROWS:
+			print(f"More than {MAX_PLAN_ROWS} resource types and groups to plan, crawling without shards!!!")
+			return None
+		if not counts:
+			return None
 
-		except Exception as e:
-			print(e)
-			print("Error Retreiving data from resource graph!!!")
+		groups_per_type = {}
+		for row in counts:
+			groups_per_type[row['type']] = groups_per_type.get(row['type'], 0) + 1
+
+		# heap of (resources in shard, shard number, {type: [resource groups]})
+		shards = [(0, n, {}) for n in range(min(n_shards, len(counts)))]
+		for row in sorted(counts, key=lambda r: r['count_'], reverse=True):
+			size, n, pairs = heapq.heappop(shards)
+			pairs.setdefault(row['type'], []).append(row['resourceGroup'])
+			heapq.heappush(shards, (size + row['count_'], n, pairs))
+
+		queries = []
+		all_filters = []
+		for _, _, pairs in sorted(shards, key=lambda s: s[1]):
+			filters = []
+			for typ, groups in pairs.items():
+				if len(groups) == groups_per_type[typ]:
+					# shard holds the whole type, no need to list its resource groups
+					filters.append(f"type == {self._kql_string(typ)}")
+				else:
+					group_list = ', '.join(self._kql_string(rg) for rg in groups)
+					filters.append(f"(type == {self._kql_string(typ)} and resourceGroup in ({group_list}))")
+			queries.append("resources | where " + " or ".join(filters))
+			all_filters.extend(filters)
+		# everything not matched by a planned shard, usually empty
+		queries.append("resources | where not(" + " or ".join(all_filters) + ")")
+		return queries
+
+	def iter_resources_sharded(self, refresh=False):
+		"""This yields info of each resource, crawling planned shards with max_workers parallel queries.
+		Workers hand rows over in batches through a bounded queue as they are fetched, so at most a few batches per
+		worker are held in memory whatever the size of a shard. Resources seen in another shard are dropped by id."""
+
+		queries = self.plan_shards(self.max_workers * SHARDS_PER_WORKER)
+		if queries is None:
+			yield from self.iter_resources(refresh=refresh)
+			return
+
+		batches = queue.Queue(maxsize=2 * self.max_workers)
+		stop = threading.Event()
+
+		def put(item):
+			# waits for room in the queue, unless the consumer has stopped reading
+			while not stop.is_set():
+				try:
+					batches.put(item, timeout=1)
+					return True
+				except queue.Full:
+					pass
+			return False
+
+		def crawl(query):
+			error = None
+			try:
+				batch = []
+				for r in self.iter_cached_results(query, refresh=refresh):
+					batch.append(r)
+					if len(batch) >= SHARD_BATCH_ROWS:
+						if not put(batch):
+							return
+						batch = []
+				if batch:
+					put(batch)
+			except Exception as e:
+				error = e
+			finally:
+				# None marks the end of a shard, an exception ends the whole crawl
+				put(error)
 
-		data_list = [] 
-		for r in res:
-			sd = NestedToSimpleDict(r)
-			data_list.append(sd.simple_dict)
+		seen_ids = set()
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			for query in queries:
+				executor.submit(crawl, query)
+			try:
+				running = len(queries)
+				while running:
+					batch = batches.get()
+					if batch is None:
+						running -= 1
+						continue
+					if isinstance(batch, Exception):
+						raise batch
+					# workers only fetch raw rows, flattening stays in this thread so column stats are counted once per resource
+					for r in batch:
+						res_id = r.get('id')
+						if res_id is not None:
+							if res_id in seen_ids:
+								continue
+							seen_ids.add(res_id)
+						sd = NestedToSimpleDict(r, stats=self.column_stats)
+						yield sd.simple_dict
+			finally:
+				stop.set()
 
-		return data_list
+	def collect_resources(self, refresh=False):
+		"""This yields info of every resource in the subscription, in shards when more than one worker is configured"""
+		if self.max_workers > 1:
+			return self.iter_resources_sharded(refresh=refresh)
+		return self.iter_resources(refresh=refresh)
+
+	@staticmethod
+	def group_by_type(resources):
+		"""Returns a dictionary with resource type as key and list of resources of that type as value.
+		The lists hold references to the resources, so grouping never copies them."""
+		res_by_type = {}
+		for res in resources:
+			try:
+				tp = res['type']
+			except KeyError:
+				print("Resource without any type attribute found!!!")
+				continue
+			res_by_type.setdefault(str(tp), []).append(res)
+		return res_by_type
 
 	def get_resoure_type(self):
 		""" This returns 2 items i.e list of resource types and
-		a dictionary with resource type as key and list of resources that corresponds to that type """
-	
-		data_list = self.get_resources()
-		
-		# Making a dictionary with keys as type of resource and value as a list of resources
-		res_by_type = {}
+		a dictionary with resource type as key and list of resources that corresponds to that type.
+		In spill to disk mode the dictionary is a ResourceShards object that reads resources of a type from disk when accessed."""
 
-		for res in data_list:
+		# Making a dictionary with keys as type of resource and value as a list of resources
+		if self.spill_to_disk:
+			res_by_type = ResourceShards(self.spill_dir, self.max_buffered_rows)
+			for res in self.collect_resources():
 				try:
 					tp = res['type']
-					if tp in res_by_type.keys():
-						res_by_type[str(tp)].append(res)
-					else:
-						res_by_type[str(tp)] = [res]
-				except:
+				except KeyError:
 					print("Resource without any type attribute found!!!")
+					continue
+				res_by_type.append(str(tp), res)
+			res_by_type.flush()
+		else:
+			res_by_type = self.group_by_type(self.collect_resources())
 		#print(res_by_type)
 		all_type = [typ for typ in res_by_type.keys()]
 		#print(all_type)
 
 		return all_type, res_by_type
 
-	def save_to_excel(self, file_name='AzureInventory.xlsx'):
-		"""This converts data into  dataframe and saves them into a excel sheet"""
+	def _fold_sparse(self, row, sparse):
+		"""Removes sparse columns from a resource, keeping their values as a single json string unless they are dropped.
+		When the json string doesn't fit into an excel cell the columns of the resource are kept as they are."""
+		kept = {}
+		folded = {}
+		for key, value in row.items():
+			if key not in sparse:
+				kept[key] = value
+			elif not ColumnStats.is_empty(value):
+				folded[key] = value
+		if folded and self.sparse_mode == 'fold':
+			folded_json = json.dumps(folded, separators=(',', ':'), default=str)
+			if len(folded_json) <= EXCEL_CELL_LIMIT:
+				kept[SPARSE_COLUMN] = folded_json
+			else:
+				# a cut json string would be invalid and lose the rest of the values
+				kept.update(folded)
+		return kept
+
+	def build_frame(self, typ, rows):
+		"""Converts resources of a type into a dataframe with sparse columns pruned and repetitive strings as categories"""
+		if self.min_fill_rate:
+			sparse = self.column_stats.sparse_columns(typ, self.min_fill_rate)
+			if sparse:
+				rows = [self._fold_sparse(row, sparse) for row in rows]
+
+		df = pd.DataFrame(rows)
+		for column in df.columns:
+			if column in CATEGORY_COLUMNS or str(column).endswith(CATEGORY_SUFFIXES):
+				try:
+					df[column] = df[column].astype('category')
+				except TypeError:
+					# column holds unhashable values like lists, leaving it as it is
+					pass
+		return df
+
+	@staticmethod
+	def get_sheet_names(types):
+		"""Maps every resource type to a unique excel worksheet name. Names are the last part of the type,
+		cut to the 31 characters excel allows and numbered when two types end up with the same name."""
+		sheet_names = {}
+		used = set()
+		for typ in types:
+			base = re.sub(r'[\[\]:*?/\\]', '_', str(typ).split('/')[-1])[:31] or 'resources'
+			sheet_name = base
+			n = 1
+			# excel compares worksheet names case insensitively
+			while sheet_name.lower() in used:
+				suffix = f'_{n}'
+				sheet_name = base[:31 - len(suffix)] + suffix
+				n += 1
+			used.add(sheet_name.lower())
+			sheet_names[typ] = sheet_name
+		return sheet_names
+
+	def save_to_excel(self, file_name='AzureInventory.xlsx', res_by_type=None):
+		"""This converts data into  dataframe and saves them into a excel sheet.
+		Resources are collected from azure unless res_by_type from get_resoure_type is passed."""
 		file_path = os.path.join(self.file_path, file_name)
-		_, res_by_type = self.get_resoure_type()
-		# converting dicts to dataframe and mapping dataframe to the excel sheet name.
-		all_df = {}
+		collected = res_by_type is None
+		if collected:
+			_, res_by_type = self.get_resoure_type()
+
+		#saving all the dataframes in a excel sheel within different worksheet for each  resource type.
+		# dataframes are built and written one resource type at a time, so only one of them is held in memory.
+		sheet_names = self.get_sheet_names(res_by_type)
+		try:
+			with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
+				for typ, sheet_name in sheet_names.items():
+					df = self.build_frame(typ, res_by_type[typ])
+					df.to_excel(writer, sheet_name=sheet_name)
+					del df
+		finally:
+			if collected and isinstance(res_by_type, ResourceShards):
+				res_by_type.close()
+
+		return file_path
+
+	def build_snapshot(self, res_by_type):
+		"""Returns an InventorySnapshot of the resources returned by get_resoure_type"""
+		snapshot = InventorySnapshot(snapshot_dir=self.file_path)
+		# resources are fingerprinted one type at a time, their property crcs go straight to the snapshot file
 		for typ in res_by_type:
-			df = pd.DataFrame(res_by_type[typ])
-			sheet_name = str(typ).split('/')[-1]
-			if sheet_name in all_df.keys():
-				all_df[str(sheet_name)].append(df)
-			else:
-				all_df[str(sheet_name)] = [df]
+			for res in res_by_type[typ]:
+				snapshot.add(res)
+		return snapshot
 
-		#saving all the dataframes in a excel sheel within different worksheet for each  resource type
+	def save_changes_report(self, snapshot, previous=None, file_name='AzureInventoryChanges.xlsx'):
+		"""Saves resources added, removed and modified since the previous snapshot into an excel sheet.
+		Without a previous snapshot every resource is reported as added."""
+		file_path = os.path.join(self.file_path, file_name)
+		if previous is None:
+			previous = InventorySnapshot(taken='None')
+		added, removed, modified = snapshot.diff(previous)
 
-		writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+		summary = pd.DataFrame([
+			('Previous inventory', previous.taken),
+			('Current inventory', snapshot.taken),
+			('Added', len(added)),
+			('Removed', len(removed)),
+			('Modified', len(modified))
+		], columns=['item', 'value'])
 
-		for sheet, frame in all_df.items():
-			frame[0].to_excel(writer, sheet_name=sheet)
-		writer.save()
+		with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
+			summary.to_excel(writer, sheet_name='Summary', index=False)
+			pd.DataFrame(added, columns=CHANGE_COLUMNS).to_excel(writer, sheet_name='Added', index=False)
+			pd.DataFrame(removed, columns=CHANGE_COLUMNS).to_excel(writer, sheet_name='Removed', index=False)
+			pd.DataFrame(modified, columns=CHANGE_COLUMNS + ('changed_properties',)).to_excel(writer, sheet_name='Modified', index=False)
 
 		return file_path
 
 
+class BlobStore:
+	"""Uploads files to an azure storage blob container and shares them through a read only SAS link.
+	An Azurite connection string can be used in place of a storage account for local testing."""
+	def __init__(self, connection_string, container_name='inventory-reports'):
+		# imported here so azure-storage-blob is only required when reports are shared through blob storage
+		from azure.storage.blob import BlobServiceClient
+		from azure.core.exceptions import ResourceExistsError
+
+		self.service_client = BlobServiceClient.from_connection_string(connection_string)
+		# SAS links are signed with the account key, so a connection string holding only a SAS token can't be used
+		if getattr(self.service_client.credential, 'account_key', None) is None:
+			print("Storage connection string has no AccountKey, which is needed to create SAS links for the reports!!!")
+			sys.exit()
+		self.container_client = self.service_client.get_container_client(container_name)
+		try:
+			self.container_client.create_container()
+		except ResourceExistsError:
+			pass
+
+	def upload(self, file_path, blob_name=None):
+		"""Uploads a file to the container and returns name of the blob"""
+		if blob_name is None:
+			blob_name = pathlib.Path(file_path).name
+		# passing the file handle lets the sdk upload the file in blocks instead of reading it at once
+		with open(file_path, 'rb') as f:
+			self.container_client.upload_blob(name=blob_name, data=f, overwrite=True)
+		return blob_name
+
+	def download(self, blob_name, file_path):
+		"""Downloads a blob into a file, returns False if the blob doesn't exist"""
+		from azure.core.exceptions import ResourceNotFoundError
+
+		blob_client = self.container_client.get_blob_client(blob_name)
+		try:
+			downloader = blob_client.download_blob()
+		except ResourceNotFoundError:
+			return False
+		with open(file_path, 'wb') as f:
+			downloader.readinto(f)
+		return True
+
+	def get_sas_url(self, blob_name, expiry_hours=24):
+		"""Returns a read only url for the blob which expires after the given number of hours"""
+		from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+
+		sas_token = generate_blob_sas(
+			account_name=self.service_client.account_name,
+			container_name=self.container_client.container_name,
+			blob_name=blob_name,
+			account_key=self.service_client.credential.account_key,
+			permission=BlobSasPermissions(read=True),
+			expiry=datetime.utcnow() + timedelta(hours=expiry_hours)
+		)
+		blob_client = self.container_client.get_blob_client(blob_name)
+		return f"{blob_client.url}?{sas_token}"
+
+
 class SendMail:
 	"""Send email using sendgrid"""
 	def __init__(self, sender_id, recipient_id ,subject='Sample subject',
-	  message_body='Test Message', attachment_path=None, sg_api_key=None):
+	  message_body='Test Message', attachment_path=None, sg_api_key=None,
+	  max_attachment_size=MAX_ATTACHMENT_SIZE, blob_store=None, link_expiry_hours=24):
 		if sg_api_key is None:
 			print("Kindly Enter an Valid sendgrid API key")
 			sys.exit()
 		self._sg_api_key = sg_api_key
-		self.from_email = Email(str(sender_id)) 
+		self.from_email = Email(str(sender_id))
 		self.recipient_id = To(recipient_id)
 		self.subject = subject
 		self.message_body = message_body
-		self.attachment_path = attachment_path	
+		self.attachment_path = attachment_path
+		self.max_attachment_size = max_attachment_size
+		self.blob_store = blob_store
+		self.link_expiry_hours = link_expiry_hours
 		self.sg = self.login()
-		
+
 	def login(self):
 		"""Login to sendgrid"""
-		
+
 		try:
 			sg = sendgrid.SendGridAPIClient(api_key=self._sg_api_key)
 		except Exception as e:
@@ -202,47 +941,128 @@ class SendMail:
 			sys.exit()
 		return sg
 
+	def compress_attachment(self):
+		"""Zip compress the attachment into an archive next to it and returns path of the archive.
+		attachment_path can also be a list of files, which are all put into the archive of the first one."""
+		if isinstance(self.attachment_path, (list, tuple)):
+			sources = [pathlib.Path(path) for path in self.attachment_path]
+		else:
+			sources = [pathlib.Path(self.attachment_path)]
+		zip_path = sources[0].with_suffix('.zip')
+		# ZipFile.write reads the source in chunks, so the report is never loaded into memory as a whole
+		with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+			for source in sources:
+				zf.write(source, arcname=source.name)
+		return str(zip_path)
+
+	@staticmethod
+	def encode_file(file_path, chunk_size=3 * 256 * 1024):
+		"""Base64 encodes a file chunk by chunk, chunk size is a multiple of 3 so no chunk gets padded.
+		This is not streaming, the sendgrid api takes an attachment as one base64 string inside the json body of the mail,
+		so the whole encoded file is held in memory (twice while the chunks are joined). max_attachment_size caps its size."""
+		encoded_chunks = []
+		with open(file_path, 'rb') as f:
+			for chunk in iter(lambda: f.read(chunk_size), b''):
+				encoded_chunks.append(base64.b64encode(chunk).decode())
+		return ''.join(encoded_chunks)
+
 	def send(self):
 		"""Sends email"""
-	
-		content = Content("text/plain", self.message_body)
-		mail = Mail(self.from_email, self.recipient_id, self.subject, content)
 
-		if self.attachment_path is not None:
+		message_body = self.message_body
+		attachedFile = None
+		zip_path = None
 
-			with open(self.attachment_path, 'rb') as f:
-				data = f.read()
-				f.close()
-			encoded_file = base64.b64encode(data).decode()
-			file_extension = pathlib.Path(self.attachment_path).suffix
-			file_name = pathlib.Path(self.attachment_path).name
+		try:
+			if self.attachment_path is not None:
+
+				zip_path = self.compress_attachment()
+				zip_size = os.path.getsize(zip_path)
+				file_name = pathlib.Path(zip_path).name
+
+				if zip_size <= self.max_attachment_size:
+					attachedFile = Attachment(
+						FileContent(self.encode_file(zip_path)),
+						FileName(str(file_name)),
+						FileType('application/zip'),
+						Disposition('attachment')
+					)
 
-			attachedFile = Attachment(
-				FileContent(encoded_file),
-				FileName(str(file_name)),
-				FileType(f'application/{file_extension}'),
-				Disposition('attachment')
-			)
+				elif self.blob_store is not None:
+					# report is too big to be mailed, so sharing a time limited link to it instead
+					blob_name = self.blob_store.upload(zip_path, blob_name=f"{date.today()}/{file_name}")
+					link = self.blob_store.get_sas_url(blob_name, expiry_hours=self.link_expiry_hours)
+					message_body = (f"{message_body}\n\nThe report is too large to be attached ({zip_size / (1024 * 1024):.1f} MB compressed)."
+						f" It can be downloaded within the next {self.link_expiry_hours} hours from:\n{link}")
+
+				else:
+					print(f"Compressed attachment is {zip_size} bytes which is more than the limit of {self.max_attachment_size} bytes"
+						" and no blob storage is configured to share it!!!")
+					sys.exit()
 
-			mail.attachment = attachedFile
+			content = Content("text/plain", message_body)
+			mail = Mail(self.from_email, self.recipient_id, self.subject, content)
 
-		# Get a JSON-ready representation of the Mail object
-		mail_json = mail.get()
+			if attachedFile is not None:
+				mail.attachment = attachedFile
 
-		# Send an HTTP POST request to /mail/send
-		response = self.sg.client.mail.send.post(request_body=mail_json)
-		print(response.status_code)
-		print(response.headers)
+			# Get a JSON-ready representation of the Mail object
+			mail_json = mail.get()
+
+			# Send an HTTP POST request to /mail/send
+			response = self.sg.client.mail.send.post(request_body=mail_json)
+			print(response.status_code)
+			print(response.headers)
+		finally:
+			# archive is only needed while sending, the report itself is left where it was saved
+			if zip_path is not None and os.path.exists(zip_path):
+				os.remove(zip_path)
 
 		return
 
 if __name__ == '__main__':
 
+	report_mode = 'full'           # change to 'changes' to mail only the resources added, removed or modified since the previous run
+	include_full_report = False    # set to True to attach the full inventory along with the changes report
+	if report_mode not in ('full', 'changes'):
+		print(f"report_mode can only be full or changes, not {report_mode}!!!")
+		sys.exit()
+
 	try:
 		file_name='AzureInventory.xlsx'
 		subscription_id = ["<SUBSCRIPTION ID HERE>"]
-		data = DataCollector(subscription_id[0])
-		attachment_path = data.save_to_excel(file_name)
+		spill_to_disk = False  # set to True for very large subscriptions, resources are then kept on disk per type instead of memory
+		min_fill_rate = 0.01   # columns filled for less than 1% of the resources of a type are folded into a single json column
+		query_cache = QueryCache(ttl=15 * 60)  # re-runs within 15 minutes reuse resource graph results, e.g. after a mail failure
+		max_workers = 4        # parallel resource graph queries, the estate is split into shards when this is more than 1
+		data = DataCollector(subscription_id[0], spill_to_disk=spill_to_disk, min_fill_rate=min_fill_rate,
+		  query_cache=query_cache, max_workers=max_workers)
+
+		blob_store = None
+		if BLOB_CONN_STR:
+			blob_store = BlobStore(data.get_secret(BLOB_CONN_STR))
+		elif report_mode == 'changes':
+			print("WARNING: no blob storage is configured, the inventory snapshot is only kept in TEMP."
+				" Automation sandboxes don't keep files between runs, so every resource will be reported as added!!!")
+
+		_, res_by_type = data.get_resoure_type()
+		attachment_path = []
+
+		if report_mode == 'changes':
+			# automation sandboxes don't keep files between runs, so the snapshot is kept in blob storage when it is configured
+			snapshot_name = f'AzureInventorySnapshot_{subscription_id[0]}.jsonl.gz'
+			snapshot_path = os.path.join(data.file_path, snapshot_name)
+			if blob_store is not None:
+				blob_store.download(f'snapshots/{snapshot_name}', snapshot_path)
+			previous = InventorySnapshot.load(snapshot_path)
+			snapshot = data.build_snapshot(res_by_type)
+			attachment_path.append(data.save_changes_report(snapshot, previous))
+
+		if report_mode == 'full' or include_full_report:
+			attachment_path.append(data.save_to_excel(file_name, res_by_type=res_by_type))
+
+		if isinstance(res_by_type, ResourceShards):
+			res_by_type.close()
 	except Exception as e:
 		print(e)
 		print("Not able to retrieve data!!!")
@@ -252,12 +1072,28 @@ if __name__ == '__main__':
 	#print(sg_api_key)
 	from_email = "<ENTER EMAIL ADDRESS OF THE SEND GRIDE VERIDIED SENDER>"  # Change to your verified sender
 	to_email = "<ENTER EMAIL ADDRESS OF RECIPENT>"  # Change to your recipient
-	subject = f"Azure Inventory on {date.today()}"
-	message_body = f"""Hello Team,
+	if report_mode == 'changes':
+		subject = f"Azure Inventory changes on {date.today()}"
+		since = previous.taken if previous is not None else "the first run, so all the resources are listed as added"
+		message_body = f"""Hello Team,
+Kindly find the changes in Azure inventory as of {date.today()} since {since} in the Attachment.
+
+Thanks & Regards,
+Azure Automation (pyauto)"""
+	else:
+		subject = f"Azure Inventory on {date.today()}"
+		message_body = f"""Hello Team,
 Kindly find the Azure inventory as of {date.today()} in the Attachment.
 
 Thanks & Regards,
 Azure Automation (pyauto)"""
 
-	mailbox = SendMail(from_email, to_email, subject, message_body, attachment_path, sg_api_key=str(sg_api_key))
+	mailbox = SendMail(from_email, to_email, subject, message_body, attachment_path, sg_api_key=str(sg_api_key), blob_store=blob_store)
 	mailbox.send()
+
+	if report_mode == 'changes':
+		# snapshot is only replaced after the mail is sent, so a re-run after a failure reports the same changes
+		snapshot.save(snapshot_path)
+		snapshot.close()
+		if blob_store is not None:
+			blob_store.upload(snapshot_path, blob_name=f'snapshots/{snapshot_name}')
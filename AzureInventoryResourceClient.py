@@ -8,8 +8,8 @@ from azure.identity import DefaultAzureCredential
 from azure.mgmt.resource import ResourceManagementClient
 import pandas as pd
 
-import os, sys, json, base64, pathlib
-from datetime import date
+import os, sys, json, base64, pathlib, zipfile, re
+from datetime import date, datetime, timedelta
 from azure.keyvault.secrets import SecretClient
 import automationassets
 
@@ -20,6 +20,15 @@ from sendgrid.helpers.mail import Mail, Email, To, Content, Attachment, FileCont
 KEY_VAULT = automationassets.get_automation_variable(str("KEY_VAULT_NAME"))	
 # Retreiving name of the Secret inside key vault that contain sendgrid api key.
 SG_API_KEY = automationassets.get_automation_variable("sendgridAPIKEY")
+# Retreiving name of the Secret inside key vault that contain a storage connection string, used to share reports too large to mail.
+# This variable is optional, reports that are over the attachment limit can't be sent without it.
+try:
+	BLOB_CONN_STR = automationassets.get_automation_variable("blobConnectionString")
+except Exception:
+	BLOB_CONN_STR = None
+
+# Largest compressed attachment in bytes that is mailed inline (sendgrid limits a mail to 30MB after base64 encoding).
+MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024
 
 
 class DataCollector:
@@ -70,74 +79,141 @@ class DataCollector:
 				break
 		return  rg_lst, res_list, rg_to_res
 
+	@staticmethod
+	def group_by_type(resources):
+		"""Returns a dictionary with resource type as key and list of resources of that type as value.
+		The lists hold references to the resources, so grouping never copies them."""
+		res_by_type = {}
+		for res in resources:
+			try:
+				tp = res['type']
+			except KeyError:
+				print("Resource without any type attribute found!!!")
+				continue
+			res_by_type.setdefault(str(tp), []).append(res)
+		return res_by_type
+
 	def get_resoure_type(self):
 		""" This returns 2 items i.e list of resource types and
 		a dictionary with resource type as key and list of resources that corresponds to that type """
 
 		# Making a dictionary with keys as type of resource and value as a list of resources
-		res_by_type = {}
 		_, _, rg_to_res = self.get_rg_resource()
 
+		data_list = []
 		for rg, value in rg_to_res.items():
 			for res in value:
-				try:
-					tp = res['type']
-					res['resource_group'] = rg
-					if tp in res_by_type.keys():
-						res_by_type[str(tp)].append(res)
-					else:
-						res_by_type[str(tp)] = [res]
-				except:
-					print("Resource without any type attribute found!!!")
+				res['resource_group'] = rg
+				data_list.append(res)
+		res_by_type = self.group_by_type(data_list)
 		#print(res_by_type)
 		all_type = [typ for typ in res_by_type.keys()]
 		#print(all_type)
 
 		return all_type, res_by_type
 
+	@staticmethod
+	def get_sheet_names(types):
+		"""Maps every resource type to a unique excel worksheet name. Names are the last part of the type,
+		cut to the 31 characters excel allows and numbered when two types end up with the same name."""
+		sheet_names = {}
+		used = set()
+		for typ in types:
+			base = re.sub(r'[\[\]:*?/\\]', '_', str(typ).split('/')[-1])[:31] or 'resources'
+			sheet_name = base
+			n = 1
+			# excel compares worksheet names case insensitively
+			while sheet_name.lower() in used:
+				suffix = f'_{n}'
+				sheet_name = base[:31 - len(suffix)] + suffix
+				n += 1
+			used.add(sheet_name.lower())
+			sheet_names[typ] = sheet_name
+		return sheet_names
+
 	def save_to_excel(self, file_name='AzureInventory.xlsx'):
 		"""This converts data into  dataframe and saves them into a excel sheet"""
 		file_path = os.path.join(self.file_path, file_name)
 		_, res_by_type = self.get_resoure_type()
-		# converting dicts to dataframe and mapping dataframe to the excel sheet name.
-		all_df = {}
-		for typ in res_by_type:
-			df = pd.DataFrame(res_by_type[typ])
-			sheet_name = str(typ).split('/')[-1]
-			if sheet_name in all_df.keys():
-				all_df[str(sheet_name)].append(df)
-			else:
-				all_df[str(sheet_name)] = [df]
+		sheet_names = self.get_sheet_names(res_by_type)
 
-		#saving all the dataframes in a excel sheel within different worksheet for each  resource type
+		#saving all the dataframes in a excel sheel within different worksheet for each  resource type.
+		# dataframes are built and written one resource type at a time, so only one of them is held in memory.
+		with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
+			for typ, sheet_name in sheet_names.items():
+				df = pd.DataFrame(res_by_type[typ])
+				df.to_excel(writer, sheet_name=sheet_name)
+				del df
 
-		writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+		return file_path
 
-		for sheet, frame in all_df.items():
-			frame[0].to_excel(writer, sheet_name=sheet)
-		writer.save()
 
-		return file_path
+class BlobStore:
+	"""Uploads files to an azure storage blob container and shares them through a read only SAS link.
+	An Azurite connection string can be used in place of a storage account for local testing."""
+	def __init__(self, connection_string, container_name='inventory-reports'):
+		# imported here so azure-storage-blob is only required when reports are shared through blob storage
+		from azure.storage.blob import BlobServiceClient
+		from azure.core.exceptions import ResourceExistsError
+
+		self.service_client = BlobServiceClient.from_connection_string(connection_string)
+		# SAS links are signed with the account key, so a connection string holding only a SAS token can't be used
+		if getattr(self.service_client.credential, 'account_key', None) is None:
+			print("Storage connection string has no AccountKey, which is needed to create SAS links for the reports!!!")
+			sys.exit()
+		self.container_client = self.service_client.get_container_client(container_name)
+		try:
+			self.container_client.create_container()
+		except ResourceExistsError:
+			pass
+
+	def upload(self, file_path, blob_name=None):
+		"""Uploads a file to the container and returns name of the blob"""
+		if blob_name is None:
+			blob_name = pathlib.Path(file_path).name
+		# passing the file handle lets the sdk upload the file in blocks instead of reading it at once
+		with open(file_path, 'rb') as f:
+			self.container_client.upload_blob(name=blob_name, data=f, overwrite=True)
+		return blob_name
+
+	def get_sas_url(self, blob_name, expiry_hours=24):
+		"""Returns a read only url for the blob which expires after the given number of hours"""
+		from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+
+		sas_token = generate_blob_sas(
+			account_name=self.service_client.account_name,
+			container_name=self.container_client.container_name,
+			blob_name=blob_name,
+			account_key=self.service_client.credential.account_key,
+			permission=BlobSasPermissions(read=True),
+			expiry=datetime.utcnow() + timedelta(hours=expiry_hours)
+		)
+		blob_client = self.container_client.get_blob_client(blob_name)
+		return f"{blob_client.url}?{sas_token}"
 
 
 class SendMail:
 	"""Send email using sendgrid"""
 	def __init__(self, sender_id, recipient_id ,subject='Sample subject',
-	  message_body='Test Message', attachment_path=None, sg_api_key=None):
+	  message_body='Test Message', attachment_path=None, sg_api_key=None,
+	  max_attachment_size=MAX_ATTACHMENT_SIZE, blob_store=None, link_expiry_hours=24):
 		if sg_api_key is None:
 			print("Kindly Enter an Valid sendgrid API key")
 			sys.exit()
 		self._sg_api_key = sg_api_key
-		self.from_email = Email(str(sender_id)) 
+		self.from_email = Email(str(sender_id))
 		self.recipient_id = To(recipient_id)
 		self.subject = subject
 		self.message_body = message_body
-		self.attachment_path = attachment_path	
+		self.attachment_path = attachment_path
+		self.max_attachment_size = max_attachment_size
+		self.blob_store = blob_store
+		self.link_expiry_hours = link_expiry_hours
 		self.sg = self.login()
-		
+
 	def login(self):
 		"""Login to sendgrid"""
-		
+
 		try:
 			sg = sendgrid.SendGridAPIClient(api_key=self._sg_api_key)
 		except Exception as e:
@@ -146,37 +222,77 @@ class SendMail:
 			sys.exit()
 		return sg
 
+	def compress_attachment(self):
+		"""Zip compress the attachment into an archive next to it and returns path of the archive"""
+		source = pathlib.Path(self.attachment_path)
+		zip_path = source.with_suffix('.zip')
+		# ZipFile.write reads the source in chunks, so the report is never loaded into memory as a whole
+		with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+			zf.write(source, arcname=source.name)
+		return str(zip_path)
+
+	@staticmethod
+	def encode_file(file_path, chunk_size=3 * 256 * 1024):
+		"""Base64 encodes a file chunk by chunk, chunk size is a multiple of 3 so no chunk gets padded.
+		This is not streaming, the sendgrid api takes an attachment as one base64 string inside the json body of the mail,
+		so the whole encoded file is held in memory (twice while the chunks are joined). max_attachment_size caps its size."""
+		encoded_chunks = []
+		with open(file_path, 'rb') as f:
+			for chunk in iter(lambda: f.read(chunk_size), b''):
+				encoded_chunks.append(base64.b64encode(chunk).decode())
+		return ''.join(encoded_chunks)
+
 	def send(self):
 		"""Sends email"""
-	
-		content = Content("text/plain", self.message_body)
-		mail = Mail(self.from_email, self.recipient_id, self.subject, content)
-
-		if self.attachment_path is not None:
 
-			with open(self.attachment_path, 'rb') as f:
-				data = f.read()
-				f.close()
-			encoded_file = base64.b64encode(data).decode()
-			file_extension = pathlib.Path(self.attachment_path).suffix
-			file_name = pathlib.Path(self.attachment_path).name
+		message_body = self.message_body
+		attachedFile = None
+		zip_path = None
 
-			attachedFile = Attachment(
-				FileContent(encoded_file),
-				FileName(str(file_name)),
-				FileType(f'application/{file_extension}'),
-				Disposition('attachment')
-			)
-
-			mail.attachment = attachedFile
-
-		# Get a JSON-ready representation of the Mail object
-		mail_json = mail.get()
-
-		# Send an HTTP POST request to /mail/send
-		response = self.sg.client.mail.send.post(request_body=mail_json)
-		print(response.status_code)
-		print(response.headers)
+		try:
+			if self.attachment_path is not None:
+
+				zip_path = self.compress_attachment()
+				zip_size = os.path.getsize(zip_path)
+				file_name = pathlib.Path(zip_path).name
+
+				if zip_size <= self.max_attachment_size:
+					attachedFile = Attachment(
+						FileContent(self.encode_file(zip_path)),
+						FileName(str(file_name)),
+						FileType('application/zip'),
+						Disposition('attachment')
+					)
+
+				elif self.blob_store is not None:
+					# report is too big to be mailed, so sharing a time limited link to it instead
+					blob_name = self.blob_store.upload(zip_path, blob_name=f"{date.today()}/{file_name}")
+					link = self.blob_store.get_sas_url(blob_name, expiry_hours=self.link_expiry_hours)
+					message_body = (f"{message_body}\n\nThe report is too large to be attached ({zip_size / (1024 * 1024):.1f} MB compressed)."
+						f" It can be downloaded within the next {self.link_expiry_hours} hours from:\n{link}")
+
+				else:
+					print(f"Compressed attachment is {zip_size} bytes which is more than the limit of {self.max_attachment_size} bytes"
+						" and no blob storage is configured to share it!!!")
+					sys.exit()
+
+			content = Content("text/plain", message_body)
+			mail = Mail(self.from_email, self.recipient_id, self.subject, content)
+
+			if attachedFile is not None:
+				mail.attachment = attachedFile
+
+			# Get a JSON-ready representation of the Mail object
+			mail_json = mail.get()
+
+			# Send an HTTP POST request to /mail/send
+			response = self.sg.client.mail.send.post(request_body=mail_json)
+			print(response.status_code)
+			print(response.headers)
+		finally:
+			# archive is only needed while sending, the report itself is left where it was saved
+			if zip_path is not None and os.path.exists(zip_path):
+				os.remove(zip_path)
 
 		return
 
@@ -202,5 +318,9 @@ Kindly find the Azure inventory as of {date.today()} in the Attachment.
 Thanks & Regards,
 Azure Automation (pyauto)"""
 
-	mailbox = SendMail(from_email, to_email, subject, message_body, attachment_path, sg_api_key=str(sg_api_key))
+	blob_store = None
+	if BLOB_CONN_STR:
+		blob_store = BlobStore(data.get_secret(BLOB_CONN_STR))
+
+	mailbox = SendMail(from_email, to_email, subject, message_body, attachment_path, sg_api_key=str(sg_api_key), blob_store=blob_store)
 	mailbox.send()
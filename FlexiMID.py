@@ -8,14 +8,176 @@
 import requests
 from azure.identity import DefaultAzureCredential
 import sys
+import threading
+from datetime import datetime, timedelta
 import time
 
+ARG_URL = 'https://management.azure.com/providers/Microsoft.ResourceGraph/resources?api-version=2021-03-01'
+# All the flexible servers of a subscription with their state, from the management api.
+SERVERS_URL = 'https://management.azure.com/subscriptions/{subscription}/providers/Microsoft.DBForPostgreSql/flexibleServers?api-version=2020-02-14-preview'
+
+# Seconds to wait for a server to reach the desired state before giving up.
+ACTION_TIMEOUT = 30 * 60
+
+# Latest state change of the watched servers from the resource graph change feed.
+# filters limits every server to the changes made since its action was requested.
+STATE_CHANGES_QUERY = """resourcechanges
+| extend targetResourceId = tolower(tostring(properties.targetResourceId)),
+    changeTime = todatetime(properties.changeAttributes.timestamp),
+    newState = tostring(properties.changes['properties.state'].newValue)
+| where isnotempty(newState) and ({filters})
+| summarize arg_max(changeTime, newState) by targetResourceId
+| project id = targetResourceId, state = newState"""
+
+
+class FlexiStateWatcher:
+    """Tracks the state of any number of flexible servers with one resource graph query per interval.
+    Polls read state changes of all the watched servers from the change feed, and every resync_every polls
+    the state of all the servers is listed from the management api instead with one request per subscription, in case
+    the change feed missed or hasn't recorded a transition yet. Waiting operations are woken up as soon as the desired
+    state shows up."""
+
+    def __init__(self, auth_header, subscriptions, interval=15, resync_every=4, change_feed_overlap=300):
+        self.auth_header = auth_header
+        self.subscriptions = list(subscriptions)
+        self.interval = interval
+        self.resync_every = resync_every
+        # changes show up in the change feed with some delay, so every poll looks back this many seconds further
+        self.change_feed_overlap = change_feed_overlap
+        self._since = datetime.utcnow()
+        self._polls = 0
+        self._states = {}
+        # time the action of every server was requested, older changes of the server are ignored
+        self._requested = {}
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def run_query(self, query):
+        """Runs a resource graph query and returns its rows"""
+        body = {'subscriptions': self.subscriptions, 'query': query, 'options': {'resultFormat': 'objectArray'}}
+        response = requests.post(ARG_URL, json=body, headers=self.auth_header)
+        response.raise_for_status()
+        return response.json()['data']
+
+    def watch(self, server_id, state=None, requested=None):
+        """Starts tracking a server, state is its last known state and requested the utc time its action was requested"""
+        with self._lock:
+            self._states[server_id.lower()] = state
+            self._requested[server_id.lower()] = requested if requested is not None else datetime.utcnow()
+
+    def wait_for(self, server_id, desired_state, timeout=None):
+        """Blocks until the server is in the desired state, returns False if timeout seconds pass before that"""
+        server_id = server_id.lower()
+        event = threading.Event()
+        with self._lock:
+            self._states.setdefault(server_id, None)
+            self._requested.setdefault(server_id, datetime.utcnow())
+            if self._states[server_id] == desired_state:
+                return True
+            self._waiters.setdefault(server_id, []).append((desired_state, event))
+            # polling runs in a single background thread shared by all the waiting operations
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            # timed out, the operation is not waiting anymore
+            if (desired_state, event) in self._waiters.get(server_id, []):
+                self._waiters[server_id].remove((desired_state, event))
+        return event.is_set()
+
+    def _set_state(self, server_id, state):
+        with self._lock:
+            if self._states.get(server_id) != state:
+                print(f"Server {server_id.split('/')[-1]} is in {state} state")
+            self._states[server_id] = state
+            waiting = []
+            for desired_state, event in self._waiters.get(server_id, []):
+                if desired_state == state:
+                    event.set()
+                else:
+                    waiting.append((desired_state, event))
+            self._waiters[server_id] = waiting
+
+    def poll(self):
+        """Reads state of all the watched servers with a single query"""
+        with self._lock:
+            requested = dict(self._requested)
+        if not requested:
+            return
+
+        self._polls += 1
+        if self._polls % self.resync_every == 0:
+            self.resync()
+            return
+
+        started = datetime.utcnow()
+        window = self._since - timedelta(seconds=self.change_feed_overlap)
+        filters = []
+        for server_id, action_time in requested.items():
+            # the overlap looks back for late changes, but never before the action of the server was requested
+            since = max(window, action_time).strftime('%Y-%m-%dT%H:%M:%SZ')
+            filters.append(f"(targetResourceId == '{server_id}' and changeTime >= datetime({since}))")
+        for row in self.run_query(STATE_CHANGES_QUERY.format(filters=' or '.join(filters))):
+            self._set_state(row['id'], row['state'])
+        self._since = started
+
+    def list_states(self):
+        """Returns current state of all the flexible servers in the watched subscriptions, keyed by lower cased id"""
+        states = {}
+        for subscription in self.subscriptions:
+            url = SERVERS_URL.format(subscription=subscription)
+            while url:
+                response = requests.get(url, headers=self.auth_header)
+                response.raise_for_status()
+                page = response.json()
+                for server in page.get('value', []):
+                    states[server['id'].lower()] = server.get('properties', {}).get('state')
+                url = page.get('nextLink')
+        return states
+
+    def resync(self):
+        """Reads current state of the servers that are still waited for, with one management api request per subscription"""
+        with self._lock:
+            waiting = [server_id for server_id, waiters in self._waiters.items() if waiters]
+        if not waiting:
+            return
+        states = self.list_states()
+        for server_id in waiting:
+            if server_id not in states:
+                print(f"Server {server_id.split('/')[-1]} is not found in its subscription!!!")
+                continue
+            state = states[server_id]
+            with self._lock:
+                unchanged = self._states.get(server_id) == state
+            if unchanged:
+                print(f"Server {server_id.split('/')[-1]} is still in {state} state, waiting...")
+            self._set_state(server_id, state)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                print("Got ERROR while polling state of the servers:", e)
+            with self._lock:
+                if not any(self._waiters.values()):
+                    self._thread = None
+                    return
+
+
 class FlexiAuto:
     def __init__(self, subscription, resource_group, server_name, action):
         self.subscription_id = subscription
         self.resource_group = resource_group
         self.server_name = server_name
         self.action = action
+        self.server_id = (f'/subscriptions/{subscription}/resourceGroups/{resource_group}'
+                          f'/providers/Microsoft.DBforPostgreSQL/flexibleServers/{server_name}')
         self.AuthHeader = {'Authorization': 'Bearer ' + self.get_token()}
         self.current_status = self.get_status()
 
@@ -33,7 +195,7 @@ class FlexiAuto:
     def get_status(self):
         """This function returns the info about the flexiserver"""
 
-        url = f'https://management.azure.com/subscriptions/{self.subscription_id}/resourceGroups/{self.resource_group}providers/Microsoft.DBForPostgreSql/flexibleServers/{self.server_name}?api-version=2020-02-14-preview'
+        url = f'https://management.azure.com/subscriptions/{self.subscription_id}/resourceGroups/{self.resource_group}/providers/Microsoft.DBForPostgreSql/flexibleServers/{self.server_name}?api-version=2020-02-14-preview'
         try:
             response = requests.get(url, headers=self.AuthHeader)
             res = response.json()
@@ -56,7 +218,7 @@ class FlexiAuto:
             raise Exception("Action can only be start or stop")
         return expected_state, desired_state
 
-    def perform_action(self):
+    def perform_action(self, watcher=None, timeout=ACTION_TIMEOUT):
 
         expected_state, desired_state = self.get_expected_state()
         if self.current_status == desired_state:
@@ -68,6 +230,7 @@ class FlexiAuto:
             try:
                 url = f'https://management.azure.com/subscriptions/{self.subscription_id}/resourceGroups/{self.resource_group}/providers/Microsoft.DBForPostgreSql/flexibleServers/{self.server_name}/{self.action}?api-version=2020-02-14-preview'
 
+                requested = datetime.utcnow()
                 response = requests.post(url, json={}, headers=self.AuthHeader)
             except Exception as e:
                 print(f'[-]Some Error occured while requesting to {self.action} the flexi server'
@@ -86,11 +249,19 @@ class FlexiAuto:
             print(f"Request to {self.action} server {self.server_name} was sent successfully.")
 
         print(f"[+]Getting info for the {self.server_name} Flexi Server...[+]")
-        while self.current_status != desired_state:
-            print('waiting for 30 sec to check for server status !!!')
-            time.sleep(30)
-            self.current_status = self.get_status()
-            print(self.current_status)
+        if watcher is not None:
+            # state is followed by the watcher shared by all the servers, instead of getting this server every 30 sec
+            watcher.watch(self.server_id, self.current_status, requested)
+            if not watcher.wait_for(self.server_id, desired_state, timeout):
+                print(f"[-]Flexi Server {self.server_name} is not in {desired_state} state after {timeout} sec, Quiting[-]")
+                sys.exit()
+            self.current_status = desired_state
+        else:
+            while self.current_status != desired_state:
+                print('waiting for 30 sec to check for server status !!!')
+                time.sleep(30)
+                self.current_status = self.get_status()
+                print(self.current_status)
         print(f"[-]Flexi Server {self.server_name} is in {self.action} state now...[-]")
         return True
 
@@ -104,14 +275,19 @@ if __name__ == "__main__":
     serverName = '<ENTER SERVER NAME HERE>'  # Name of the flexible server
     action = 'start'              # change to stop for stopping the server
     server = FlexiAuto(subscriptionId, resourceGroupName, serverName, action)
-    server.perform_action()
+    watcher = FlexiStateWatcher(server.AuthHeader, [subscriptionId])  # follows the server state through resource graph
+    server.perform_action(watcher, timeout=ACTION_TIMEOUT)
 
     # -------------------------- for multiple servers --------------------------
 
     # rg_list = ['rg1', 'rg2']                             # list of resource group for the flexible servers
     # server_name_list = ['server1', 'server2']            # list of flexible server in the same order as rg_list
     # action = 'start'                                     # change to stop for stopping the server
-    # servers = [FlexiAuto(rg, server) for rg, server in zip(rg_list, server_name_list)]
-    # actions = [server.perform_action() for server in servers]
+    # servers = [FlexiAuto(subscriptionId, rg, server, action) for rg, server in zip(rg_list, server_name_list)]
+    # # a single watcher follows all the servers with one resource graph query per interval
+    # watcher = FlexiStateWatcher(servers[0].AuthHeader, [subscriptionId])
+    # from concurrent.futures import ThreadPoolExecutor
+    # with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+    #     actions = list(executor.map(lambda server: server.perform_action(watcher, timeout=ACTION_TIMEOUT), servers))
 
 
@@ -7,7 +7,7 @@ from azure.mgmt.compute import ComputeManagementClient
 from azure.identity import DefaultAzureCredential
 from datetime import date, datetime
 import automationassets
-import sys, json
+import os, sys, json, re, gzip, hashlib, tempfile, time, uuid
 
 
 # Get snapshot_tags variable from the automation account variables
@@ -26,11 +26,247 @@ except:
 	sys.exit()
 
 
+class QueryCache:
+	"""Caches resource graph query results on local disk, one compressed json lines file per entry.
+	Entries are keyed by the normalized query text and the set of subscriptions, they expire after ttl seconds and
+	the least recently used entries are evicted once the cache grows over max_size bytes."""
+
+	# single or double quoted kql string literals, whitespace inside of them is significant
+	_string_literal = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
+	def __init__(self, cache_dir=None, ttl=900, max_size=256 * 1024 * 1024):
+		if cache_dir is None:
+			cache_dir = os.path.join(tempfile.gettempdir(), 'arg_query_cache')
+		os.makedirs(cache_dir, exist_ok=True)
+		self.cache_dir = cache_dir
+		self.ttl = ttl
+		self.max_size = max_size
+
+	@classmethod
+	def normalize_query(cls, query):
+		"""Collapses whitespace outside of string literals, so differently formatted queries share an entry"""
+		parts = cls._string_literal.split(query)
+		# string literals are captured by the split and end up at the odd indexes
+		for i in range(0, len(parts), 2):
+			parts[i] = ' '.join(parts[i].split())
+		return ''.join(parts)
+
+	def _path(self, query, subscriptions):
+		key = json.dumps([self.normalize_query(query), sorted(subscriptions)])
+		return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json.gz')
+
+	@staticmethod
+	def _remove(path):
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+	@staticmethod
+	def _iter_rows(f):
+		with f:
+			for line in f:
+				yield json.loads(line)
+
+	def get(self, query, subscriptions):
+		"""Returns an iterator over the cached rows of a query, or None if there is no fresh entry for it"""
+		path = self._path(query, subscriptions)
+		try:
+			f = gzip.open(path, 'rt', encoding='utf-8')
+			header = json.loads(f.readline())
+		except (OSError, EOFError, ValueError):
+			return None
+
+		if time.time() - header['created'] > self.ttl:
+			f.close()
+			self._remove(path)
+			return None
+
+		# modification time of an entry marks when it was last used, for the LRU eviction
+		os.utime(path)
+		return self._iter_rows(f)
+
+	def put(self, query, subscriptions, rows):
+		"""Yields the rows while writing them to the cache, the entry is only stored once all the rows are consumed"""
+		path = self._path(query, subscriptions)
+		tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+		stored = False
+		try:
+			with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+				header = {'created': time.time(), 'query': query, 'subscriptions': sorted(subscriptions)}
+				f.write(json.dumps(header) + '\n')
+				for row in rows:
+					f.write(json.dumps(row, separators=(',', ':'), default=str) + '\n')
+					yield row
+			os.replace(tmp_path, path)
+			stored = True
+		finally:
+			if not stored:
+				self._remove(tmp_path)
+		self.evict()
+
+	def evict(self):
+		"""Deletes least recently used entries until the cache fits into max_size"""
+		entries = []
+		for entry in os.scandir(self.cache_dir):
+			if not entry.name.endswith('.json.gz'):
+				continue
+			try:
+				stat = entry.stat()
+			except FileNotFoundError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+		total_size = sum(size for _, size, _ in entries)
+		for _, size, path in sorted(entries):
+			if total_size <= self.max_size:
+				break
+			self._remove(path)
+			total_size -= size
+
+	def clear(self):
+		"""Deletes all the entries"""
+		for entry in os.scandir(self.cache_dir):
+			if entry.name.endswith('.json.gz'):
+				self._remove(entry.path)
+
+
+# Virtual machines of a subscription, projected with the same column names as the per vm query of SnapIt.
+VM_INDEX_QUERY = """Resources
+| where type =~ 'microsoft.compute/virtualmachines'
+| project id, name, subscriptionId, resourceGroup, location,
+	properties_extended_instanceView_powerState_displayStatus = properties.extended.instanceView.powerState.displayStatus"""
+
+# Changes of vms since a point in time, from the resource graph change feed. Rows keep the id of the change
+# so results can be paged with skip tokens, the latest change of every vm is picked by refresh_changes.
+VM_CHANGES_QUERY = """resourcechanges
+| extend changeTime = todatetime(properties.changeAttributes.timestamp),
+	targetResourceId = tostring(properties.targetResourceId),
+	targetResourceType = tostring(properties.targetResourceType),
+	changeType = tostring(properties.changeType)
+| where changeTime > datetime({since}) and targetResourceType =~ 'microsoft.compute/virtualmachines'
+| project id, targetResourceId, changeType, changeTime"""
+
+# Change feed keeps 14 days of changes, an index older than this is rebuilt instead of refreshed from it.
+MAX_INCREMENTAL_AGE = 7 * 24 * 60 * 60
+# Changes show up in the change feed with some delay, so every refresh looks back this many seconds before the last one.
+CHANGE_FEED_OVERLAP = 10 * 60
+
+
+class VmIndex:
+	"""Index of the virtual machines of a subscription by name, used to resolve a vm name to its id and resource group.
+	It is built from one bulk resource graph query, kept in a local json file for ttl seconds and afterwards
+	refreshed from the resource graph change feed, so lookups are served from memory. Disks are not indexed,
+	they are always read live by SnapIt.get_disk_data."""
+	def __init__(self, run_query, subscription_id, path=None, ttl=3600):
+		self.run_query = run_query
+		if path is None:
+			path = os.path.join(tempfile.gettempdir(), f'vm_index_{subscription_id}.json')
+		self.path = path
+		self.ttl = ttl
+		self.built = 0
+		self.refreshed = 0
+		# vms keyed by their lower cased id
+		self.vms = {}
+		self._vms_by_name = {}
+
+	def load(self, refresh=False):
+		"""Loads the index from its file, refreshing or rebuilding it when it is older than ttl. refresh=True rebuilds it."""
+		if not refresh and self._read():
+			now = time.time()
+			if now - self.refreshed <= self.ttl:
+				return self
+			if now - self.built <= MAX_INCREMENTAL_AGE:
+				try:
+					self.refresh_changes()
+					self._write()
+					return self
+				except Exception as e:
+					print(e)
+					print("Can't refresh the vm index from the change feed, rebuilding it...")
+		self.rebuild()
+		self._write()
+		return self
+
+	def rebuild(self):
+		"""Builds the index from scratch with one bulk query"""
+		started = time.time()
+		self.vms = {}
+		self._add(self.run_query(VM_INDEX_QUERY, refresh=True))
+		self.built = self.refreshed = started
+		self._reindex()
+
+	def refresh_changes(self):
+		"""Updates the index with vms created, updated or deleted since its last refresh"""
+		started = time.time()
+		since = datetime.utcfromtimestamp(self.refreshed - CHANGE_FEED_OVERLAP).strftime('%Y-%m-%dT%H:%M:%SZ')
+		changes = self.run_query(VM_CHANGES_QUERY.format(since=since), refresh=True)
+
+		latest = {}
+		for change in changes:
+			res_id = change['targetResourceId'].lower()
+			if res_id not in latest or str(change['changeTime']) > str(latest[res_id]['changeTime']):
+				latest[res_id] = change
+
+		changed_ids = []
+		for res_id, change in latest.items():
+			if change['changeType'] == 'Delete':
+				self.vms.pop(res_id, None)
+			else:
+				changed_ids.append(res_id)
+
+		# changed vms are queried again in batches, to keep every query short
+		for i in range(0, len(changed_ids), 200):
+			id_list = ', '.join(f"'{res_id}'" for res_id in changed_ids[i:i + 200])
+			self._add(self.run_query(f"{VM_INDEX_QUERY}\n| where id in~ ({id_list})", refresh=True))
+
+		self.refreshed = started
+		self._reindex()
+
+	def _add(self, rows):
+		for row in rows:
+			self.vms[row['id'].lower()] = row
+
+	def _reindex(self):
+		self._vms_by_name = {}
+		for vm_id, vm in self.vms.items():
+			self._vms_by_name.setdefault(vm['name'].lower(), []).append(vm_id)
+
+	def _read(self):
+		try:
+			with open(self.path) as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return False
+		self.built = data['built']
+		self.refreshed = data['refreshed']
+		self.vms = data['vms']
+		self._reindex()
+		return True
+
+	def _write(self):
+		tmp_path = f'{self.path}.{uuid.uuid4().hex}.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump({'built': self.built, 'refreshed': self.refreshed, 'vms': self.vms}, f)
+		os.replace(tmp_path, self.path)
+
+	def find_vms(self, vm_name, resource_group=None):
+		"""Returns list of vms with the name, only the ones in the resource group if it is given"""
+		vms = [self.vms[vm_id] for vm_id in self._vms_by_name.get(vm_name.lower(), [])]
+		if resource_group is not None:
+			vms = [vm for vm in vms if vm['resourceGroup'].lower() == resource_group.lower()]
+		return vms
+
+
 class SnapIt:
 
-	def __init__(self, subscription_id):
+	def __init__(self, subscription_id, query_cache=None):
 		self.subscription_id = subscription_id[0]
 		self.credential = DefaultAzureCredential()
+		# resource graph results are reused from this QueryCache when it is set
+		self.query_cache = query_cache
+		# vm names are resolved from this VmIndex once load_vm_index is called
+		self.vm_index = None
 		try:
 			self.compute_client = ComputeManagementClient(self.credential, self.subscription_id)
 			self.argClient = arg.ResourceGraphClient(self.credential)
@@ -39,35 +275,71 @@ class SnapIt:
 			sys.exit()
 		
 	
-	def run_query(self, query):
-		"""Runs azure resouce graph query"""
-		
+	def run_query(self, query, refresh=False):
+		"""Runs azure resouce graph query, results are served from the query cache if it has a fresh entry
+		for the query. refresh=True bypasses the cache."""
+
+		subscriptions = [self.subscription_id]
+		if self.query_cache is not None and not refresh:
+			cached = self.query_cache.get(query, subscriptions)
+			if cached is not None:
+				return list(cached)
+
 		argQueryOptions = arg.models.QueryRequestOptions(result_format="objectArray")
-		# Create query
-		argQuery = arg.models.QueryRequest(subscriptions=subscription_id, query=query, options=argQueryOptions)
-		# Run query
-		argResults = self.argClient.resources(argQuery)
-		data = argResults.as_dict()['data']
+		data = []
+		while True:
+			# Create query
+			argQuery = arg.models.QueryRequest(subscriptions=subscriptions, query=query, options=argQueryOptions)
+			# Run query
+			argResults = self.argClient.resources(argQuery).as_dict()
+			data.extend(argResults['data'])
+			# results over a page are fetched with the skip token of the previous page
+			skip_token = argResults.get('skip_token')
+			if not skip_token:
+				break
+			argQueryOptions = arg.models.QueryRequestOptions(result_format="objectArray", skip_token=skip_token)
+		if self.query_cache is not None:
+			data = list(self.query_cache.put(query, subscriptions, data))
 		return data
 
 
-	def get_vm_data(self, vm_name):
-		"""Get details for a vm"""
-
-		get_vm = f"""Resources
-		| where type has "microsoft.compute/virtualmachines"
-		| extend name = tostring(name)
-		| where  name == '{vm_name}'
-		| project id, name, subscriptionId, resourceGroup, location, properties.extended.instanceView.powerState.displayStatus"""
+	def load_vm_index(self, path=None, ttl=3600, refresh=False):
+		"""Loads the vm index, vm names are resolved from it afterwards"""
 		try:
-			vm_data = self.run_query(get_vm)
+			self.vm_index = VmIndex(self.run_query, self.subscription_id, path, ttl).load(refresh=refresh)
 		except Exception as e:
 			print(e)
-			print(f"Can't Retreive data for VM {vm_name}!!!")
-			sys.exit()
+			print("Can't load the vm index, querying resource graph for every vm instead!!!")
+			self.vm_index = None
+		return self.vm_index
+
+	def get_vm_data(self, vm_name, resource_group=None):
+		"""Get details for a vm, resource group is needed when more than one vm has the same name.
+		A vm missing from the vm index is looked up with a live query, it may have been created after the last refresh."""
+
+		vm_data = []
+		if self.vm_index is not None:
+			vm_data = self.vm_index.find_vms(vm_name, resource_group)
+
+		if len(vm_data) == 0:
+			rg_filter = f"| where resourceGroup =~ '{resource_group}'" if resource_group is not None else ""
+			get_vm = f"""Resources
+			| where type has "microsoft.compute/virtualmachines"
+			| extend name = tostring(name)
+			| where  name == '{vm_name}'
+			{rg_filter}
+			| project id, name, subscriptionId, resourceGroup, location, properties.extended.instanceView.powerState.displayStatus"""
+			try:
+				vm_data = self.run_query(get_vm, refresh=self.vm_index is not None)
+			except Exception as e:
+				print(e)
+				print(f"Can't Retreive data for VM {vm_name}!!!")
+				sys.exit()
 
 		if len(vm_data) > 1:
-			print('More Than one vms available with the same name. Quiting...')
+			resource_groups = ', '.join(vm['resourceGroup'] for vm in vm_data)
+			print(f'More Than one vms available with the same name in resource groups {resource_groups}.'
+				' Kindly pass the resource group of the vm. Quiting...')
 			sys.exit()
 
 		if len(vm_data) == 0:
@@ -77,7 +349,8 @@ class SnapIt:
 		return vm_data
 
 	def get_disk_data(self, vm_id):
-		"""Get all the disks for a vm"""
+		"""Get all the disks for a vm. Disks are always read with a live query that bypasses the query cache,
+		a disk attached since the cache entry was made would otherwise be left without a snapshot."""
 
 		get_disk = f"""Resources
 		| where type has "microsoft.compute/disks"
@@ -85,12 +358,17 @@ class SnapIt:
 		| where  diskState == 'Attached' and managedBy == "{vm_id}"
 		| project id, name, diskState, managedBy, subscriptionId, resourceGroup, location, properties.osType"""
 		try:
-			disk_data = self.run_query(get_disk)
+			disk_data = self.run_query(get_disk, refresh=True)
 		except Exception as e:
 			print(e)
 			print("Not able to retreive data for disk !!!")
 			sys.exit()
 
+		if len(disk_data) == 0:
+			# vm was resolved from the vm index but has been deleted since
+			print(f'No disks are attached to the vm {vm_id}. Quiting...')
+			sys.exit()
+
 		return disk_data
 
 	def take_snap(self, disk_data, tags):
@@ -124,8 +402,13 @@ if __name__ == "__main__":
 
 	subscription_id = ["<SUBSCRIPTION ID>"] # change for subscription id
 	vm_name = 'vm1-1'
-	snapit_inst = SnapIt(subscription_id)
-	vm_data = snapit_inst.get_vm_data(vm_name)
+	resource_group = None  # set to the resource group of the vm when more than one vm has the same name
+	query_cache = QueryCache(ttl=5 * 60)  # runbooks resolving the same vm within 5 minutes reuse the query results
+	snapit_inst = SnapIt(subscription_id, query_cache=query_cache)
+	use_vm_index = False  # the index is kept in TEMP, set to True only where files are kept between runs e.g. a hybrid worker
+	if use_vm_index:
+		snapit_inst.load_vm_index(ttl=5 * 60)  # index older than 5 minutes is refreshed from the change feed
+	vm_data = snapit_inst.get_vm_data(vm_name, resource_group)
 	vm_id = vm_data[0]['id']
 	disk_data = snapit_inst.get_disk_data(vm_id)
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Benchmarks the CPU hot paths of AzureInventory.py on synthetic resources, one stage at a time: flattening with
+NestedToSimpleDict, grouping by type with group_by_type (as get_resoure_type does), building the sheet dataframes and
+writing them with xlsxwriter (as save_to_excel does). Every stage reports rows per second and peak memory, and is
+compared with the stored baseline when the baseline was recorded with the same settings.
+
+usage: python benchmarks/bench_inventory.py [--rows 20000] [--depth 2] [--list-length 4] [--mix vm=3,nsg=2,disk=4,webapp=1]
+                                            [--repeat 3] [--tolerance 0.2] [--save-baseline]"""
+
+import argparse, json, os, shutil, sys, tempfile, tracemalloc
+
+from common import load_runbook, best_of
+from synthetic import ResourceGenerator, DEFAULT_MIX, parse_mix
+
+
+# Baselines depend on the machine they were recorded on, so this file is ignored by git.
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+
+def measure(func, repeat):
+	"""Returns the best time of repeat runs, and peak memory in bytes of one more run traced by tracemalloc.
+	Memory is traced in a separate run, as tracing slows down the code it measures."""
+	elapsed, result = best_of(repeat, func)
+	tracemalloc.start()
+	func()
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return elapsed, peak, result
+
+
+def load_baseline(settings):
+	"""Returns stored stage results, None when there is no baseline or it was recorded with other settings"""
+	try:
+		with open(BASELINE_PATH) as f:
+			baseline = json.load(f)
+	except (OSError, ValueError):
+		print(f"No baseline at {BASELINE_PATH}, run with --save-baseline to store one.")
+		return None
+	if baseline['settings'] != settings:
+		print(f"Baseline was recorded with other settings {baseline['settings']}, not comparing.")
+		return None
+	return baseline['stages']
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rows', type=int, default=20000, help='number of synthetic resources')
+	parser.add_argument('--depth', type=int, default=2, help='extra levels of nested dictionaries under properties')
+	parser.add_argument('--list-length', type=int, default=4, help='length of lists like data disks and security rules')
+	parser.add_argument('--mix', default=','.join(f'{shape}={weight}' for shape, weight in DEFAULT_MIX.items()),
+		help='relative number of resources per shape')
+	parser.add_argument('--min-fill-rate', type=float, default=0.01, help='min_fill_rate of the DataCollector')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the fastest one is reported')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow down and memory growth against the baseline')
+	parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+	args = parser.parse_args()
+
+	inventory = load_runbook('AzureInventory')
+	import pandas as pd
+
+	settings = {'rows': args.rows, 'depth': args.depth, 'list_length': args.list_length, 'mix': parse_mix(args.mix),
+		'min_fill_rate': args.min_fill_rate, 'seed': args.seed}
+	generator = ResourceGenerator(settings['mix'], depth=args.depth, list_length=args.list_length, seed=args.seed)
+	documents = list(generator.generate(args.rows))
+
+	collector = inventory.DataCollector(generator.subscription_id, min_fill_rate=args.min_fill_rate)
+	tmp_dir = tempfile.mkdtemp(prefix='inventory_bench_')
+	collector.file_path = tmp_dir
+	workbook_path = os.path.join(tmp_dir, 'AzureInventory.xlsx')
+
+	def flatten():
+		collector.column_stats = inventory.ColumnStats()
+		return [inventory.NestedToSimpleDict(doc, stats=collector.column_stats).simple_dict for doc in documents]
+
+	def group():
+		return inventory.DataCollector.group_by_type(flat_rows)
+
+	def build_frames():
+		return {typ: collector.build_frame(typ, rows) for typ, rows in res_by_type.items()}
+
+	def write_excel():
+		with pd.ExcelWriter(workbook_path, engine='xlsxwriter') as writer:
+			for typ, sheet_name in sheet_names.items():
+				frames[typ].to_excel(writer, sheet_name=sheet_name)
+
+	results = {}
+	try:
+		elapsed, peak, flat_rows = measure(flatten, args.repeat)
+		results['flatten'] = (elapsed, peak)
+		elapsed, peak, res_by_type = measure(group, args.repeat)
+		results['group'] = (elapsed, peak)
+		elapsed, peak, frames = measure(build_frames, args.repeat)
+		results['dataframe'] = (elapsed, peak)
+		sheet_names = collector.get_sheet_names(res_by_type)
+		elapsed, peak, _ = measure(write_excel, args.repeat)
+		results['excel'] = (elapsed, peak)
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+	stages = {stage: {'rows_per_sec': args.rows / elapsed, 'peak_mb': peak / (1024 * 1024)} for stage, (elapsed, peak) in results.items()}
+	baseline = load_baseline(settings)
+
+	columns = sum(len(frame.columns) for frame in frames.values())
+	print(f"{args.rows} resources, {len(res_by_type)} types, {columns} columns, best of {args.repeat}")
+	print(f"{'stage':<12}{'time ms':>10}{'rows/s':>12}{'peak MB':>10}{'base rows/s':>13}{'base MB':>10}  status")
+	regressions = []
+	for stage, (elapsed, _) in results.items():
+		current = stages[stage]
+		line = f"{stage:<12}{elapsed * 1000:>10.1f}{current['rows_per_sec']:>12,.0f}{current['peak_mb']:>10.1f}"
+		status = ''
+		if baseline is not None and stage in baseline:
+			base = baseline[stage]
+			line += f"{base['rows_per_sec']:>13,.0f}{base['peak_mb']:>10.1f}"
+			problems = []
+			if current['rows_per_sec'] < base['rows_per_sec'] * (1 - args.tolerance):
+				problems.append('SLOWER')
+			if current['peak_mb'] > base['peak_mb'] * (1 + args.tolerance):
+				problems.append('MORE MEMORY')
+			status = ', '.join(problems) or 'ok'
+			if problems:
+				regressions.append(stage)
+		else:
+			line += f"{'-':>13}{'-':>10}"
+		print(f"{line}  {status}")
+
+	if args.save_baseline:
+		with open(BASELINE_PATH, 'w') as f:
+			json.dump({'settings': settings, 'stages': stages}, f, indent=2)
+		print(f"Baseline saved to {BASELINE_PATH}")
+
+	if regressions:
+		print(f"Regression in {', '.join(regressions)} beyond {args.tolerance:.0%} of the baseline!!!")
+		sys.exit(1)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Benchmarks grouping of flattened resources by type. Compares the dictionary loop get_resoure_type used before
+with DataCollector.group_by_type, and times the precomputed worksheet name mapping.
+
+usage: python benchmarks/bench_type_grouping.py [--rows 100000] [--types 60] [--repeat 5]"""
+
+import argparse, random
+
+from common import load_runbook, best_of
+
+
+def make_rows(n_rows, n_types, seed=0):
+	"""Returns flattened resources spread over n_types types, a few types hold most of them like in real subscriptions"""
+	rng = random.Random(seed)
+	all_type = [f'microsoft.provider{i % 7}/resource{i}' for i in range(n_types)]
+	weights = [1 / (i + 1) for i in range(n_types)]
+	return [{
+		'id': f'/subscriptions/0000/resourceGroups/rg{i % 50}/providers/{typ}/res{i}',
+		'name': f'res{i}',
+		'type': typ,
+		'location': 'westeurope',
+		'resourceGroup': f'rg{i % 50}'
+	} for i, typ in enumerate(rng.choices(all_type, weights=weights, k=n_rows))]
+
+
+def loop_grouping(data_list):
+	"""Grouping as get_resoure_type did it before group_by_type"""
+	res_by_type = {}
+	for res in data_list:
+		try:
+			tp = res['type']
+			if tp in res_by_type.keys():
+				res_by_type[str(tp)].append(res)
+			else:
+				res_by_type[str(tp)] = [res]
+		except:
+			print("Resource without any type attribute found!!!")
+	return res_by_type
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rows', type=int, default=100000)
+	parser.add_argument('--types', type=int, default=60)
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args()
+
+	inventory = load_runbook('AzureInventory')
+	data_list = make_rows(args.rows, args.types)
+
+	loop_time, expected = best_of(args.repeat, loop_grouping, data_list)
+	groups_time, groups = best_of(args.repeat, inventory.DataCollector.group_by_type, data_list)
+	sheet_time, _ = best_of(args.repeat, inventory.DataCollector.get_sheet_names, list(groups))
+
+	# both groupings have to agree before their timings mean anything
+	assert {typ: len(rows) for typ, rows in expected.items()} == {typ: len(groups[typ]) for typ in groups}
+
+	print(f"{args.rows} rows, {len(groups)} types, best of {args.repeat}")
+	print(f"{'dictionary loop':<20}{loop_time * 1000:>10.1f} ms{args.rows / loop_time:>14,.0f} rows/s")
+	print(f"{'group_by_type':<20}{groups_time * 1000:>10.1f} ms{args.rows / groups_time:>14,.0f} rows/s")
+	print(f"{'sheet names':<20}{sheet_time * 1000:>10.1f} ms")
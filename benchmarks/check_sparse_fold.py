@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Checks that folding sparse columns never builds a cell excel can't hold. A few network security groups with many
+security rules among a lot of small ones have most of their columns folded, and their folded json has to stay within
+EXCEL_CELL_LIMIT or be left as separate columns.
+
+usage: python benchmarks/check_sparse_fold.py [--small 200] [--rules 400]"""
+
+import argparse, copy, json, sys
+
+from common import load_runbook
+from synthetic import ResourceGenerator
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--small', type=int, default=200, help='number of small network security groups')
+	parser.add_argument('--rules', type=int, default=400, help='security rules of the wide network security group')
+	parser.add_argument('--min-fill-rate', type=float, default=0.01, help='min_fill_rate of the DataCollector, as in the runbook')
+	args = parser.parse_args()
+
+	inventory = load_runbook('AzureInventory')
+
+	generator = ResourceGenerator({'nsg': 1}, list_length=2)
+	documents = list(generator.generate(args.small + 1))
+	wide = documents[-1]
+	rule = wide['properties']['defaultSecurityRules'][0]
+	wide['properties']['securityRules'] = []
+	for n in range(args.rules):
+		wide_rule = copy.deepcopy(rule)
+		wide_rule['name'] = f'CustomRule{n}'
+		wide_rule['id'] = f'{wide["id"]}/securityRules/rule{n}'
+		wide['properties']['securityRules'].append(wide_rule)
+
+	collector = inventory.DataCollector(generator.subscription_id, min_fill_rate=args.min_fill_rate)
+	rows = [inventory.NestedToSimpleDict(doc, stats=collector.column_stats).simple_dict for doc in documents]
+	typ = rows[0]['type']
+	df = collector.build_frame(typ, rows)
+
+	problems = []
+	for column in df.columns:
+		for value in df[column]:
+			if isinstance(value, str) and len(value) > inventory.EXCEL_CELL_LIMIT:
+				problems.append(f"{column} has a value of {len(value)} characters")
+	if inventory.SPARSE_COLUMN in df.columns:
+		for value in df[inventory.SPARSE_COLUMN].dropna():
+			json.loads(value)
+
+	wide_row = df[df['id'] == wide['id']].iloc[0]
+	folded = inventory.SPARSE_COLUMN in df.columns and isinstance(wide_row[inventory.SPARSE_COLUMN], str)
+	print(f"{len(rows)} resources, {len(df.columns)} columns, wide resource {'folded' if folded else 'kept as columns'}")
+	if problems:
+		print('\n'.join(problems))
+		print("Cells over the excel limit found!!!")
+		sys.exit(1)
+	print("ok")
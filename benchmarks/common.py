@@ -0,0 +1,35 @@
+"""Helpers shared by the benchmarks. Benchmarks run offline, but still need the packages imported by the runbooks
+(pandas, xlsxwriter, azure sdks and sendgrid) to be installed."""
+
+import os, sys, time, types, importlib
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_runbook(name):
+	"""Imports a runbook from the root of the repository.
+	automationassets only exists inside azure automation, so a stand in that returns no variables is registered
+	when it can't be imported. Benchmarks never read automation variables."""
+	if REPO_DIR not in sys.path:
+		sys.path.insert(0, REPO_DIR)
+	try:
+		import automationassets
+	except ImportError:
+		stand_in = types.ModuleType('automationassets')
+		stand_in.get_automation_variable = lambda name: None
+		sys.modules['automationassets'] = stand_in
+	return importlib.import_module(name)
+
+
+def best_of(repeat, func, *args):
+	"""Runs func repeat times and returns the fastest run time in seconds along with the last result"""
+	best = None
+	result = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = func(*args)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best, result
@@ -0,0 +1,203 @@
+"""Generates synthetic ARM resource documents shaped like the rows resource graph returns for virtual machines,
+network security groups, managed disks and web apps. Nesting depth, list lengths and the mix of types are configurable,
+and the same seed always gives the same resources."""
+
+import random, uuid
+
+
+LOCATIONS = ['westeurope', 'northeurope', 'eastus', 'eastus2', 'centralindia', 'southeastasia']
+VM_SIZES = ['Standard_B2s', 'Standard_D2s_v3', 'Standard_D4s_v3', 'Standard_E8s_v4', 'Standard_F4s_v2']
+DISK_SKUS = [('Premium_LRS', 'Premium'), ('StandardSSD_LRS', 'Standard'), ('Standard_LRS', 'Standard')]
+TAG_NAMES = ['env', 'owner', 'costCenter', 'application', 'CHANGE', 'backup', 'criticality', 'department']
+
+# resource shapes and how many of each are generated relative to the others
+DEFAULT_MIX = {'vm': 3, 'nsg': 2, 'disk': 4, 'webapp': 1}
+
+
+class ResourceGenerator:
+	"""Generates resources of the shapes in mix. list_length sets the length of lists like data disks, security rules
+	and host names, depth adds that many extra levels of nested dictionaries under properties."""
+	def __init__(self, mix=None, depth=2, list_length=4, resource_groups=20, seed=0):
+		self.mix = mix if mix is not None else dict(DEFAULT_MIX)
+		for shape in self.mix:
+			if not hasattr(self, f'_{shape}'):
+				raise Exception(f"Unknown resource shape {shape}, it can only be one of {', '.join(DEFAULT_MIX)}")
+		self.depth = depth
+		self.list_length = list_length
+		self.rng = random.Random(seed)
+		self.subscription_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+		self.tenant_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+		self.resource_groups = [f'rg-{self.rng.choice(["app", "data", "net", "shared"])}-{i:03d}' for i in range(resource_groups)]
+
+	def generate(self, n_resources):
+		"""Yields n_resources resources"""
+		shapes = list(self.mix)
+		weights = [self.mix[shape] for shape in shapes]
+		for i, shape in enumerate(self.rng.choices(shapes, weights=weights, k=n_resources)):
+			yield getattr(self, f'_{shape}')(i)
+
+	def _uuid(self):
+		return str(uuid.UUID(int=self.rng.getrandbits(128)))
+
+	def _base(self, i, provider, typ, name):
+		rg = self.rng.choice(self.resource_groups)
+		tags = {tag: f'{tag}-{self.rng.randint(0, 9)}' for tag in self.rng.sample(TAG_NAMES, self.rng.randint(0, 5))}
+		return {
+			'id': f'/subscriptions/{self.subscription_id}/resourceGroups/{rg}/providers/{provider}/{name}',
+			'name': name,
+			'type': typ,
+			'tenantId': self.tenant_id,
+			'kind': '',
+			'location': self.rng.choice(LOCATIONS),
+			'resourceGroup': rg,
+			'subscriptionId': self.subscription_id,
+			'managedBy': '',
+			'sku': None,
+			'plan': None,
+			'tags': tags,
+			'identity': None,
+			'zones': None,
+			'extendedLocation': None
+		}
+
+	def _nested(self, level):
+		"""Returns dictionary nested level times, with a few leaves and a short list of dictionaries on each level"""
+		node = {'enabled': self.rng.random() < 0.5, 'value': self.rng.randint(0, 1000), 'label': f'level{level}'}
+		if level > 0:
+			node['items'] = [{'key': f'k{j}', 'value': str(self.rng.random())} for j in range(min(self.list_length, 3))]
+			node['child'] = self._nested(level - 1)
+		return node
+
+	def _properties(self, properties):
+		if self.depth > 0:
+			properties['extensions'] = self._nested(self.depth - 1)
+		return properties
+
+	def _managed_disk(self, rg_id, disk_name):
+		return {
+			'id': f'{rg_id}/providers/Microsoft.Compute/disks/{disk_name}',
+			'storageAccountType': self.rng.choice(DISK_SKUS)[0]
+		}
+
+	def _vm(self, i):
+		name = f'vm-{i:06d}'
+		res = self._base(i, 'Microsoft.Compute/virtualMachines', 'microsoft.compute/virtualmachines', name)
+		rg_id = res['id'].split('/providers/')[0]
+		linux = self.rng.random() < 0.7
+		res['identity'] = {'type': 'SystemAssigned', 'principalId': self._uuid(), 'tenantId': self.tenant_id}
+		res['zones'] = [str(self.rng.randint(1, 3))]
+		running = self.rng.random() < 0.8
+		res['properties'] = self._properties({
+			'vmId': self._uuid(),
+			'provisioningState': 'Succeeded',
+			'hardwareProfile': {'vmSize': self.rng.choice(VM_SIZES)},
+			'storageProfile': {
+				'imageReference': {'publisher': 'Canonical' if linux else 'MicrosoftWindowsServer', 'offer': 'UbuntuServer' if linux else 'WindowsServer',
+					'sku': '18.04-LTS' if linux else '2019-Datacenter', 'version': 'latest'},
+				'osDisk': {'osType': 'Linux' if linux else 'Windows', 'name': f'{name}_OsDisk', 'createOption': 'FromImage', 'caching': 'ReadWrite',
+					'diskSizeGB': 30 if linux else 127, 'managedDisk': self._managed_disk(rg_id, f'{name}_OsDisk')},
+				'dataDisks': [{'lun': lun, 'name': f'{name}_DataDisk_{lun}', 'createOption': 'Empty', 'caching': 'None',
+					'diskSizeGB': self.rng.choice([32, 64, 128, 256, 512, 1024]), 'managedDisk': self._managed_disk(rg_id, f'{name}_DataDisk_{lun}')}
+					for lun in range(self.rng.randint(0, self.list_length))]
+			},
+			'osProfile': {
+				'computerName': name,
+				'adminUsername': 'azureuser',
+				'linuxConfiguration': {'disablePasswordAuthentication': True, 'provisionVMAgent': True,
+					'ssh': {'publicKeys': [{'path': '/home/azureuser/.ssh/authorized_keys', 'keyData': 'ssh-rsa AAAAB3Nza' + self._uuid()}]}} if linux else None,
+				'windowsConfiguration': None if linux else {'provisionVMAgent': True, 'enableAutomaticUpdates': True, 'patchSettings': {'patchMode': 'AutomaticByOS'}}
+			},
+			'networkProfile': {'networkInterfaces': [{'id': f'{rg_id}/providers/Microsoft.Network/networkInterfaces/{name}-nic{n}', 'properties': {'primary': n == 0}}
+				for n in range(self.rng.randint(1, 2))]},
+			'diagnosticsProfile': {'bootDiagnostics': {'enabled': self.rng.random() < 0.5}},
+			'extended': {'instanceView': {'computerName': name, 'osName': 'ubuntu' if linux else 'Windows Server 2019 Datacenter',
+				'powerState': {'code': 'PowerState/running' if running else 'PowerState/deallocated', 'displayStatus': 'VM running' if running else 'VM deallocated'}}}
+		})
+		return res
+
+	def _nsg(self, i):
+		name = f'nsg-{i:06d}'
+		res = self._base(i, 'Microsoft.Network/networkSecurityGroups', 'microsoft.network/networksecuritygroups', name)
+		rg_id = res['id'].split('/providers/')[0]
+
+		def rule(n, default):
+			return {
+				'name': f'{"Default" if default else "Custom"}Rule{n}',
+				'id': f'{res["id"]}/{"defaultSecurityRules" if default else "securityRules"}/rule{n}',
+				'etag': f'W/"{self._uuid()}"',
+				'type': 'Microsoft.Network/networkSecurityGroups/securityRules',
+				'properties': {'provisioningState': 'Succeeded', 'protocol': self.rng.choice(['Tcp', 'Udp', '*']),
+					'sourcePortRange': '*', 'destinationPortRange': str(self.rng.choice([22, 80, 443, 3389, 5432])),
+					'sourceAddressPrefix': self.rng.choice(['*', 'VirtualNetwork', '10.0.0.0/8']), 'destinationAddressPrefix': '*',
+					'access': self.rng.choice(['Allow', 'Deny']), 'priority': 100 + n * 10 if not default else 65000 + n,
+					'direction': self.rng.choice(['Inbound', 'Outbound']), 'sourcePortRanges': [], 'destinationPortRanges': []}
+			}
+
+		res['properties'] = self._properties({
+			'provisioningState': 'Succeeded',
+			'resourceGuid': self._uuid(),
+			'securityRules': [rule(n, False) for n in range(self.rng.randint(0, self.list_length * 2))],
+			'defaultSecurityRules': [rule(n, True) for n in range(6)],
+			'networkInterfaces': [{'id': f'{rg_id}/providers/Microsoft.Network/networkInterfaces/nic-{i}-{n}'} for n in range(self.rng.randint(0, self.list_length))]
+		})
+		return res
+
+	def _disk(self, i):
+		name = f'disk-{i:06d}'
+		res = self._base(i, 'Microsoft.Compute/disks', 'microsoft.compute/disks', name)
+		rg_id = res['id'].split('/providers/')[0]
+		sku, tier = self.rng.choice(DISK_SKUS)
+		attached = self.rng.random() < 0.85
+		res['sku'] = {'name': sku, 'tier': tier}
+		res['managedBy'] = f'{rg_id}/providers/Microsoft.Compute/virtualMachines/vm-{self.rng.randint(0, 999999):06d}' if attached else ''
+		res['zones'] = [str(self.rng.randint(1, 3))]
+		res['properties'] = self._properties({
+			'provisioningState': 'Succeeded',
+			'diskState': 'Attached' if attached else 'Unattached',
+			'diskSizeGB': self.rng.choice([30, 32, 64, 127, 128, 256, 512, 1024]),
+			'diskIOPSReadWrite': self.rng.choice([120, 500, 2300, 5000]),
+			'diskMBpsReadWrite': self.rng.choice([25, 60, 150, 200]),
+			'osType': self.rng.choice(['Linux', 'Windows', None]),
+			'hyperVGeneration': 'V1',
+			'timeCreated': f'2022-{self.rng.randint(1, 12):02d}-{self.rng.randint(1, 28):02d}T10:00:00.0000000+00:00',
+			'uniqueId': self._uuid(),
+			'networkAccessPolicy': 'AllowAll',
+			'creationData': {'createOption': self.rng.choice(['Empty', 'FromImage', 'Copy']),
+				'imageReference': {'id': f'/Subscriptions/{self.subscription_id}/Providers/Microsoft.Compute/Locations/westeurope/Publishers/Canonical/ArtifactTypes/VMImage/Offers/UbuntuServer/Skus/18.04-LTS/Versions/18.04.{i}'}},
+			'encryption': {'type': 'EncryptionAtRestWithPlatformKey'}
+		})
+		return res
+
+	def _webapp(self, i):
+		name = f'app-{i:06d}'
+		res = self._base(i, 'Microsoft.Web/sites', 'microsoft.web/sites', name)
+		rg_id = res['id'].split('/providers/')[0]
+		res['kind'] = self.rng.choice(['app', 'app,linux', 'functionapp', 'functionapp,linux'])
+		host_names = [f'{name}.azurewebsites.net'] + [f'www{n}.contoso{i}.com' for n in range(self.rng.randint(0, self.list_length))]
+		res['properties'] = self._properties({
+			'name': name,
+			'state': self.rng.choice(['Running', 'Stopped']),
+			'provisioningState': 'Succeeded',
+			'hostNames': host_names,
+			'enabledHostNames': host_names + [f'{name}.scm.azurewebsites.net'],
+			'hostNameSslStates': [{'name': host, 'sslState': self.rng.choice(['Disabled', 'SniEnabled']), 'hostType': 'Standard',
+				'thumbprint': None, 'toUpdate': None, 'virtualIP': None} for host in host_names],
+			'serverFarmId': f'{rg_id}/providers/Microsoft.Web/serverfarms/plan-{self.rng.randint(0, 50)}',
+			'httpsOnly': self.rng.random() < 0.7,
+			'clientAffinityEnabled': self.rng.random() < 0.5,
+			'outboundIpAddresses': ','.join(f'20.{self.rng.randint(0, 255)}.{self.rng.randint(0, 255)}.{self.rng.randint(0, 255)}' for _ in range(4)),
+			'siteConfig': {'numberOfWorkers': 1, 'linuxFxVersion': self.rng.choice(['PYTHON|3.9', 'NODE|16-lts', 'DOTNETCORE|6.0', '']),
+				'alwaysOn': self.rng.random() < 0.5, 'http20Enabled': False, 'minTlsVersion': '1.2', 'ftpsState': 'FtpsOnly',
+				'ipSecurityRestrictions': [{'ipAddress': 'Any', 'action': 'Allow', 'priority': 1, 'name': 'Allow all'}]},
+			'lastModifiedTimeUtc': f'2023-{self.rng.randint(1, 12):02d}-{self.rng.randint(1, 28):02d}T08:00:00.000'
+		})
+		return res
+
+
+def parse_mix(text):
+	"""Parses a type mix like 'vm=3,nsg=2,disk=4,webapp=1' into a dictionary"""
+	mix = {}
+	for item in text.split(','):
+		shape, _, weight = item.partition('=')
+		mix[shape.strip()] = float(weight) if weight else 1.0
+	return mix